@@ -0,0 +1,218 @@
+# Long running render server, which keeps trained models resident so that rendering many poses
+# does not pay for starting python, importing torch and loading a model each time.
+#
+# POST /render with a JSON body such as
+#   {"model": "models/lego.pt", "c2w": [[1,0,0,0],[0,1,0,0],[0,0,1,4]], "focal": 350, "size": 256}
+# and optionally "time" for dynamic models and "depth": true. focal is in pixels at size.
+# Loading a model unpickles it, so only the models passed to --models at start up are served.
+# It responds with an .npz holding "rgb" [size, size, 3], and for NeRFs with depth requested,
+# "depth" and "acc" [size, size]. Requests for the same model which arrive within
+# --batch-window-ms of each other are rendered together as one batch of cameras.
+import argparse
+import io
+import json
+import os
+import queue
+import socket
+import socketserver
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass
+from itertools import chain
+from http.server import ( BaseHTTPRequestHandler, ThreadingHTTPServer )
+
+import numpy as np
+import torch
+
+import runner
+import src.cameras as cameras
+import src.nerf as nerf
+from runner import ( device )
+
+def arguments():
+  a = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+  a.add_argument("--host", help="Host to listen on", type=str, default="127.0.0.1")
+  a.add_argument("--port", help="Port to listen on", type=int, default=8070)
+  a.add_argument(
+    "--unix-socket", help="Listen on this unix socket instead of host/port", type=str,
+  )
+  a.add_argument(
+    "--max-model-mb", help="Evict least recently used models above this much memory",
+    type=float, default=4096,
+  )
+  a.add_argument(
+    "--batch-window-ms", help="How long to wait for other requests to batch with",
+    type=float, default=10,
+  )
+  a.add_argument("--max-batch", help="Max # of cameras rendered at once", type=int, default=16)
+  a.add_argument(
+    "--render-chunk-rays", help="# of rays rendered at once, see runner.py", type=int, default=0,
+  )
+  a.add_argument(
+    "--render-mem-mb", help="Approximate memory budget per chunk, see runner.py",
+    type=float, default=1024,
+  )
+  a.add_argument("--amp", choices=["none", "bf16", "fp16"], default="none")
+  a.add_argument(
+    "--models", help="Models which may be rendered, any others are refused", nargs="+",
+    required=True,
+  )
+  a.add_argument("--preload", help="Load every model on start up", action="store_true")
+  args = a.parse_args()
+  # settings read by runner.render and runner.render_chunks
+  args.data_kind = "original"
+  args.crop_size = 128
+  return args
+
+def model_bytes(model):
+  return sum(t.numel() * t.element_size() for t in chain(model.parameters(), model.buffers()))
+
+# Models loaded by the render thread, evicting the least recently used ones once together they
+# use more than max_bytes. Only paths which were allowed when starting are ever loaded.
+class ModelCache:
+  def __init__(self, max_bytes: int, allowed):
+    self.max_bytes = max_bytes
+    self.allowed = set(os.path.abspath(p) for p in allowed)
+    self.models = OrderedDict()
+  def get(self, path: str):
+    path = os.path.abspath(path)
+    if path not in self.allowed: raise PermissionError(f"Model is not served: {path}")
+    if path in self.models:
+      self.models.move_to_end(path)
+      return self.models[path][0]
+    model = torch.load(path, map_location=device, weights_only=False).eval()
+    self.models[path] = (model, model_bytes(model))
+    # always keep the model which was just loaded, even if it alone is over budget.
+    while len(self.models) > 1 and self.used() > self.max_bytes:
+      evicted, _ = self.models.popitem(last=False)
+      print(f"[info]: evicted {evicted}")
+      if device != "cpu": torch.cuda.empty_cache()
+    return model
+  def used(self): return sum(size for _, size in self.models.values())
+
+@dataclass
+class RenderRequest:
+  model: str
+  c2w: torch.Tensor
+  focal: float
+  size: int
+  time: float = None
+  depth: bool = False
+  def key(self): return (os.path.abspath(self.model), self.size, self.time is None, self.depth)
+
+  @classmethod
+  def from_json(cls, body):
+    c2w = torch.tensor(body["c2w"], dtype=torch.float)
+    assert(c2w.shape in [(3,4), (4,4)]), f"c2w must be 3x4 or 4x4, got {tuple(c2w.shape)}"
+    return cls(
+      model=body["model"], c2w=c2w[:3], focal=float(body["focal"]), size=int(body["size"]),
+      time=body.get("time", None), depth=bool(body.get("depth", False)),
+    )
+
+# Renders queued requests on a single thread, coalescing those which arrive within a window.
+class Renderer:
+  def __init__(self, args):
+    self.args = args
+    self.models = ModelCache(int(args.max_model_mb * (1 << 20)), args.models)
+    self.queue = queue.Queue()
+    threading.Thread(target=self.loop, daemon=True).start()
+  def submit(self, req: RenderRequest) -> Future:
+    fut = Future()
+    self.queue.put((req, fut))
+    return fut
+  def loop(self):
+    while True:
+      pending = [self.queue.get()]
+      deadline = time.time() + self.args.batch_window_ms/1000
+      while len(pending) < self.args.max_batch:
+        try: pending.append(self.queue.get(timeout=max(deadline - time.time(), 0)))
+        except queue.Empty: break
+      groups = OrderedDict()
+      for req, fut in pending: groups.setdefault(req.key(), []).append((req, fut))
+      for group in groups.values():
+        reqs, futs = zip(*group)
+        try:
+          for fut, out in zip(futs, self.render(list(reqs))): fut.set_result(out)
+        except Exception as e:
+          for fut in futs: fut.set_exception(e)
+
+  @torch.no_grad()
+  def render(self, reqs):
+    model = self.models.get(reqs[0].model)
+    B, size = len(reqs), reqs[0].size
+    cam = cameras.NeRFCamera(
+      cam_to_world=torch.stack([r.c2w for r in reqs]).to(device),
+      focal=torch.tensor([r.focal for r in reqs], device=device), device=device,
+    )
+    times = None
+    if reqs[0].time is not None:
+      times = torch.tensor([r.time for r in reqs], device=device, dtype=torch.float)
+    with_depth = reqs[0].depth and hasattr(model, "nerf")
+
+    rgb = torch.zeros(B, size, size, 3, device=device)
+    depth = torch.zeros(B, size, size, device=device)
+    acc = torch.zeros(B, size, size, device=device)
+    for r0, r1, out in runner.render_chunks(model, cam, size, self.args, times=times):
+      rgb[:, r0:r1] = out.reshape(B, r1 - r0, size, -1)[..., :3]
+      if with_depth:
+        canon = model.nerf
+        acc[:, r0:r1] = canon.acc_smooth()[..., 0].clamp(min=0, max=1)
+        depth[:, r0:r1] = \
+          nerf.volumetric_integrate(canon.weights, nerf.expand_ts(canon.ts))[..., 0]
+
+    outs = []
+    for i in range(B):
+      buf = io.BytesIO()
+      arrays = { "rgb": rgb[i].clamp(min=0, max=1).cpu().numpy() }
+      if with_depth:
+        arrays["depth"] = depth[i].cpu().numpy()
+        arrays["acc"] = acc[i].cpu().numpy()
+      np.savez(buf, **arrays)
+      outs.append(buf.getvalue())
+    return outs
+
+class Handler(BaseHTTPRequestHandler):
+  renderer: Renderer = None
+  def do_POST(self):
+    if self.path != "/render": return self.send_error(404)
+    if self.headers.get_content_type() != "application/json":
+      return self.send_error(415, "Expected an application/json body")
+    try:
+      body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+      req = RenderRequest.from_json(body)
+      if os.path.abspath(req.model) not in self.renderer.models.allowed:
+        return self.send_error(403, f"Model is not served: {req.model}")
+      out = self.renderer.submit(req).result()
+    except (KeyError, ValueError, TypeError, AssertionError) as e:
+      return self.send_error(400, str(e))
+    except Exception as e: return self.send_error(500, str(e))
+    self.send_response(200)
+    self.send_header("Content-Type", "application/octet-stream")
+    self.send_header("Content-Length", str(len(out)))
+    self.end_headers()
+    self.wfile.write(out)
+  def log_message(self, fmt, *args): pass
+
+class UnixHTTPServer(ThreadingHTTPServer):
+  address_family = socket.AF_UNIX
+  def server_bind(self):
+    if os.path.exists(self.server_address): os.remove(self.server_address)
+    socketserver.TCPServer.server_bind(self)
+    self.server_name, self.server_port = "localhost", 0
+
+def main():
+  args = arguments()
+  Handler.renderer = Renderer(args)
+  if args.preload:
+    for path in args.models: Handler.renderer.models.get(path)
+  if args.unix_socket is not None:
+    server = UnixHTTPServer(args.unix_socket, Handler)
+    print(f"[info]: listening on {args.unix_socket}")
+  else:
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"[info]: listening on http://{args.host}:{args.port}")
+  server.serve_forever()
+
+if __name__ == "__main__": main()
@@ -1,6 +1,7 @@
 # Global runner for all NeRF methods.
 # For convenience, we want all methods using NeRF to use this one file.
 import argparse
+import contextlib
 import random
 import json
 import math
@@ -26,9 +27,15 @@ import src.refl as refl
 import src.cameras as cameras
 import src.hyper_config as hyper_config
 import src.renderers as renderers
+import src.octree as octree
+import src.march as march
 from src.lights import light_kinds
 from src.utils import ( save_image, save_plot, load_image )
-from src.neural_blocks import ( Upsampler, SpatialEncoder, StyleTransfer )
+from src.occupancy import ( OccupancyGrid )
+from src.ray_bank import ( RayBank )
+from src.neural_blocks import (
+  Upsampler, SpatialEncoder, StyleTransfer, HashEncoder, TensorEncoder, load_encoder,
+)
 
 import os
 
@@ -46,6 +53,35 @@ def arguments():
     "--derive-kind", help="Attempt to derive the kind if a single file is given",
     action="store_false",
   )
+  a.add_argument(
+    "--data-cache", help="Directory to cache decoded datasets in, for faster loading", type=str,
+  )
+  a.add_argument(
+    "--video-start", help="First frame to load for single_video", type=int, default=0,
+  )
+  a.add_argument(
+    "--video-end", help="Last frame (exclusive) to load for single_video, -1 for all",
+    type=int, default=100,
+  )
+  a.add_argument(
+    "--video-stride", help="Load every nth frame for single_video", type=int, default=1,
+  )
+  a.add_argument(
+    "--video-max-mb", help="Max RAM for single_video frames, unless --label-storage mmap",
+    type=float, default=4096,
+  )
+  a.add_argument(
+    "--label-storage", help="Where to keep labels, transferring what each step uses if not device",
+    choices=["device", "host", "mmap"], default="device",
+  )
+  a.add_argument(
+    "--label-dtype", help="Type to store labels as with --label-storage host or mmap",
+    choices=["float32", "float16", "uint8"], default="float32",
+  )
+  a.add_argument(
+    "--load-workers", help="# of threads decoding images while loading data", type=int,
+    default=min(32, os.cpu_count() or 1),
+  )
 
   a.add_argument("--outdir", help="path to output directory", type=str, default="outputs/")
   a.add_argument(
@@ -61,7 +97,23 @@ def arguments():
   a.add_argument("--neural-upsample", help="add neural upsampling", action="store_true")
   a.add_argument("--crop", help="train with cropping", action="store_true")
   a.add_argument("--crop-size",help="what size to use while cropping",type=int, default=16)
+  a.add_argument(
+    "--ray-bank", type=int, default=0,
+    help="Train on this many independent random rays from all images each step, instead of crops",
+  )
+  a.add_argument(
+    "--ray-bank-stratify", action="store_true",
+    help="Draw an equal number of rays from each image with --ray-bank",
+  )
   a.add_argument("--steps", help="Number of depth steps", type=int, default=64)
+  a.add_argument(
+    "--coarse-steps", type=int, default=32,
+    help="Number of uniform steps for the coarse pass, only used if --fine-steps > 0",
+  )
+  a.add_argument(
+    "--fine-steps", type=int, default=0,
+    help="Number of importance sampled steps placed by the coarse pass, 0 disables it",
+  )
   a.add_argument(
     "--mip", help="Use MipNeRF with different sampling", type=str, choices=["cone", "cylinder"],
   )
@@ -78,7 +130,11 @@ def arguments():
   )
   a.add_argument(
     "--model", help="which model do we want to use", type=str,
-    choices=["tiny", "plain", "ae", "volsdf", "sdf"], default="plain",
+    choices=["tiny", "plain", "ae", "volsdf", "sdf", "grid"], default="plain",
+  )
+  a.add_argument(
+    "--encoder", help="Spatial encoder for plain, ae and mlp sdf models", type=str,
+    choices=["fourier", "hash", "tensor-vm", "tensor-cp"], default="fourier",
   )
   a.add_argument(
     "--bg", help="What kind of background to use for NeRF", type=str,
@@ -205,9 +261,13 @@ def arguments():
     help="Intersect the learned SDF with a bounding sphere at the origin, < 0 is no sphere",
   )
   sdfa.add_argument(
-    "--sdf-isect-kind", choices=["sphere", "secant", "bisect"], default="sphere",
+    "--sdf-isect-kind", choices=["sphere", "secant", "bisect", "march"], default="sphere",
     help="Marching kind to use when computing SDF intersection.",
   )
+  sdfa.add_argument(
+    "--sdf-chunk-size", type=int, default=1 << 18,
+    help="Max # of points the SDF is evaluated on at once, batching steps along rays when dense",
+  )
 
   dnerfa = a.add_argument_group("dnerf")
   dnerfa.add_argument("--dnerfae", help="Use DNeRFAE on top of DNeRF", action="store_true")
@@ -220,12 +280,153 @@ def arguments():
   dnerfa.add_argument("--with-canon", help="Preload a canonical NeRF", type=str, default=None)
   dnerfa.add_argument("--fix-canon", help="Do not train canonical NeRF", action="store_true")
 
+  accel = a.add_argument_group("acceleration")
+  accel.add_argument(
+    "--bound-box", type=float, nargs=6, metavar=("X0", "Y0", "Z0", "X1", "Y1", "Z1"),
+    help="Only sample rays inside of this box, skipping rays which miss it",
+  )
+  accel.add_argument(
+    "--estimate-bound-box", action="store_true",
+    help="Estimate --bound-box from the training cameras, and alpha masks if loaded",
+  )
+  accel.add_argument(
+    "--bound-box-res", type=int, default=64, help="Grid resolution used to estimate --bound-box",
+  )
+  accel.add_argument(
+    "--bound-box-margin", type=float, default=0.1,
+    help="Pad the estimated --bound-box on each side by this fraction of its size",
+  )
+  accel.add_argument(
+    "--occupancy-grid", type=int, default=0,
+    help="Resolution of occupancy grid used to skip samples in empty space, 0 is no grid",
+  )
+  accel.add_argument(
+    "--occupancy-bound", type=float, default=1.5, help="Occupancy grid covers [-bound, bound]^3",
+  )
+  accel.add_argument(
+    "--occupancy-threshold", type=float, default=1e-2,
+    help="Alpha below which an occupancy grid cell is considered empty",
+  )
+  accel.add_argument(
+    "--occupancy-update-freq", type=int, default=16, help="# of epochs between grid updates",
+  )
+  accel.add_argument(
+    "--occupancy-warmup", type=int, default=256, help="# of epochs before the grid is updated",
+  )
+  accel.add_argument(
+    "--march-chunk", type=int, default=0,
+    help="Volume render in chunks of this many samples, retiring opaque rays. 0 is disabled",
+  )
+  accel.add_argument(
+    "--min-transmittance", type=float, default=1e-3,
+    help="Transmittance below which rays are retired when using --march-chunk",
+  )
+  accel.add_argument(
+    "--march-in-training", action="store_true",
+    help="Also use --march-chunk during training, rather than only for inference",
+  )
+  accel.add_argument(
+    "--packed", action="store_true",
+    help="Store samples in a flat buffer with per ray offsets, dropping samples in empty space",
+  )
+  accel.add_argument(
+    "--fused-composite", action="store_true",
+    help="Composite with a fused op which recomputes intermediates in backward to save memory",
+  )
+  accel.add_argument(
+    "--shade-eps", type=float, default=0,
+    help="If > 0, compute density first and only compute color for samples with weight above it",
+  )
+  accel.add_argument(
+    "--amp", help="Mixed precision for the forward pass, bf16 is used on CPU",
+    choices=["none", "bf16", "fp16"], default="none",
+  )
+  accel.add_argument(
+    "--checkpoint", type=str, default="",
+    help="Comma separated parts of the model to checkpoint: density, refl, integrator (volsdf)",
+  )
+  accel.add_argument(
+    "--checkpoint-chunk", help="# of samples per checkpointed chunk", type=int, default=1<<14,
+  )
+
+  bake = a.add_argument_group("octree baking")
+  bake.add_argument(
+    "--bake-octree", type=str, default=None,
+    help="Bake the trained NeRF into a sparse voxel octree saved here, and test with it instead",
+  )
+  bake.add_argument("--octree-depth", help="Depth of octree leaves", type=int, default=8)
+  bake.add_argument("--octree-bound", help="Octree covers [-bound, bound]^3", type=float, default=1.5)
+  bake.add_argument(
+    "--octree-sh-order", help="Spherical harmonic order of leaves", type=int, default=2,
+    choices=[0, 1, 2, 3, 4],
+  )
+  bake.add_argument(
+    "--octree-threshold", help="Alpha below which cells are pruned", type=float, default=1e-2,
+  )
+  bake.add_argument(
+    "--octree-finetune", help="# of epochs to fine-tune the baked octree", type=int, default=0,
+  )
+  bake.add_argument("--octree-lr", help="Octree fine-tuning learning rate", type=float, default=1e-2)
+
+  grid = a.add_argument_group("voxel grid")
+  grid.add_argument("--grid-res", help="Final resolution of --model grid", type=int, default=128)
+  grid.add_argument(
+    "--grid-init-res", type=int, default=0,
+    help="Initial resolution of --model grid, if > 0 it is upsampled to --grid-res over training",
+  )
+  grid.add_argument(
+    "--grid-upsample-at", type=int, nargs="*", default=[],
+    help="Epochs at which the grid is upsampled, resolution grows geometrically between them",
+  )
+  grid.add_argument("--grid-bound", help="Grid covers [-bound, bound]^3", type=float, default=1.5)
+  grid.add_argument("--grid-tv", help="Weight of grid total variation", type=float, default=0)
+
+  hash_enc = a.add_argument_group("hash encoding")
+  hash_enc.add_argument("--hash-levels", help="# of hash grid levels", type=int, default=16)
+  hash_enc.add_argument(
+    "--hash-table-size", help="log2 of # of entries per level", type=int, default=19,
+  )
+  hash_enc.add_argument(
+    "--hash-max-res", help="Resolution of the finest hash grid level", type=int, default=2048,
+  )
+  hash_enc.add_argument(
+    "--hash-sparse", action="store_true",
+    help="Use sparse gradients for hash tables, which are then optimized with SparseAdam",
+  )
+  hash_enc.add_argument(
+    "--hash-bound", help="Hash grids cover [-bound, bound]^3", type=float, default=1.5,
+  )
+
+  tensor_enc = a.add_argument_group("tensor encoding")
+  tensor_enc.add_argument(
+    "--tensor-components", help="# of components per decomposed tensor", type=int, default=16,
+  )
+  tensor_enc.add_argument(
+    "--tensor-features", help="# of features output by tensor encoding", type=int, default=27,
+  )
+  tensor_enc.add_argument("--tensor-res", help="Final tensor resolution", type=int, default=256)
+  tensor_enc.add_argument(
+    "--tensor-init-res", type=int, default=0,
+    help="Initial tensor resolution, if > 0 it is upsampled to --tensor-res over training",
+  )
+  tensor_enc.add_argument(
+    "--tensor-upsample-at", type=int, nargs="*", default=[],
+    help="Epochs at which tensors are upsampled, resolution grows geometrically between them",
+  )
+  tensor_enc.add_argument(
+    "--tensor-bound", help="Tensors cover [-bound, bound]^3", type=float, default=1.5,
+  )
+
   cam = a.add_argument_group("camera parameters")
   cam.add_argument("--near", help="near plane for camera", type=float, default=2)
   cam.add_argument("--far", help="far plane for camera", type=float, default=6)
 
   rprt = a.add_argument_group("reporting parameters")
   rprt.add_argument("-q", "--quiet", help="Silence tqdm", action="store_true")
+  rprt.add_argument(
+    "--march-stats", action="store_true",
+    help="Report how many rays are still sphere marched at each iteration when testing",
+  )
   rprt.add_argument("--save", help="Where to save the model", type=str, default="models/model.pt")
   rprt.add_argument("--log", help="Where to save log of arguments", type=str, default="log.json")
   rprt.add_argument("--save-freq", help="# of epochs between saves", type=int, default=5000)
@@ -240,6 +441,14 @@ def arguments():
   rprt.add_argument("--loss-window", help="# epochs to smooth loss over", type=int, default=250)
   rprt.add_argument("--notraintest", help="Do not test on training set", action="store_true")
   rprt.add_argument("--sphere_visualize", help="Radius to use for spherical visualization", default=None, type=int)
+  rprt.add_argument(
+    "--render-chunk-rays", type=int, default=0,
+    help="# of rays rendered at once when testing, overrides --render-mem-mb",
+  )
+  rprt.add_argument(
+    "--render-mem-mb", type=float, default=1024,
+    help="Approximate memory budget when testing, <= 0 renders --crop-size^2 rays at once",
+  )
   rprt.add_argument(
     "--duration-sec", help="Max number of seconds to run this for, s <= 0 implies None",
     type=float, default=0,
@@ -317,20 +526,66 @@ def render(
   args,
   times=None, with_noise=0.1,
 ):
-  ii, jj = torch.meshgrid(
-    torch.arange(size, device=device, dtype=torch.float),
-    torch.arange(size, device=device, dtype=torch.float),
-  )
-
-  positions = torch.stack([ii.transpose(-1, -2), jj.transpose(-1, -2)], dim=-1)
   t,l,h,w = crop
-  positions = positions[t:t+h,l:l+w,:]
-
-  rays = cam.sample_positions(positions, size=size, with_noise=with_noise)
-
-  if times is not None: return model((rays, times))
-  elif args.data_kind == "pixel-single": return model((rays, positions))
-  return model(rays)
+  positions = cameras.pixel_grid(size, device)[t:t+h,l:l+w,:]
+  rays = cam.sample_crop(crop, size=size, with_noise=with_noise, device=device)
+  return render_rays(model, rays, args, times=times, positions=positions)
+
+# renders already generated rays [B, H, W, 6]
+def render_rays(model, rays, args, times=None, positions=None):
+  with autocast(args):
+    if times is not None: out = model((rays, times))
+    elif args.data_kind == "pixel-single": out = model((rays, positions))
+    else: out = model(rays)
+  return out.float()
+
+# mixed precision context for the forward pass of the model, which does nothing for --amp none.
+# Numerically sensitive parts such as alpha compositing opt out of it with utils.fp32.
+def autocast(args):
+  amp = getattr(args, "amp", "none")
+  if amp == "none": return contextlib.nullcontext()
+  if device == "cpu":
+    assert(amp == "bf16"), "Only bf16 mixed precision is supported on CPU"
+    return torch.autocast(device_type="cpu", dtype=torch.bfloat16)
+  dtype = torch.bfloat16 if amp == "bf16" else torch.float16
+  return torch.autocast(device_type="cuda", dtype=dtype)
+
+# rough upper bound of the memory used to render one ray without gradients, assuming the outputs
+# of every linear layer are alive for every sample of the ray at once.
+def estimate_ray_bytes(model):
+  canon = getattr(model, "nerf", None)
+  samples = 1
+  if isinstance(canon, nerf.CommonNeRF): samples = canon.steps + getattr(canon, "fine_steps", 0)
+  widths = sum(m.out_features for m in model.modules() if isinstance(m, nn.Linear))
+  # each sample also holds its point, t, density, color, alpha and weight.
+  return 4 * samples * (widths + 16)
+
+# number of rays to render at once, so that --render-chunk-rays rays or --render-mem-mb of memory
+# are used. Otherwise as many rays as a training crop are rendered at once.
+def render_chunk_rays(model, args) -> int:
+  if args.render_chunk_rays > 0: return args.render_chunk_rays
+  if args.render_mem_mb > 0:
+    return max(1, int(args.render_mem_mb * (1 << 20) / estimate_ray_bytes(model)))
+  return args.crop_size * args.crop_size
+
+# number of rows of each of images images to render at once, at most one full image.
+def render_chunk_rows(model, size: int, args, images: int = 1) -> int:
+  return max(1, min(size, render_chunk_rays(model, args) // (size * images)))
+
+# number of full images which fit in one chunk, so small images are rendered together.
+def render_chunk_images(model, size: int, args) -> int:
+  return max(1, render_chunk_rays(model, args) // (size * size))
+
+# renders full images from cam in chunks of rows, yielding (first row, last row, output). If
+# cam holds more than one camera, every chunk covers the same rows of all of them.
+def render_chunks(model, cam, size: int, args, times=None):
+  rows = render_chunk_rows(model, size, args, len(cam))
+  for r0 in range(0, size, rows):
+    r1 = min(r0 + rows, size)
+    out = render(
+      model, cam, (r0, 0, r1 - r0, size), size=size, with_noise=False, times=times, args=args,
+    )
+    yield r0, r1, out
 
 def sqr(x): return x * x
 
@@ -390,6 +645,78 @@ def load_loss_fn(args, model):
   if args.model == "sdf": loss_fn = sdf.masked_loss(loss_fn)
   return loss_fn
 
+# maps epochs to the resolution a grid should be upsampled to, growing geometrically.
+def resolution_schedule(init_res: int, final_res: int, epochs):
+  epochs = sorted(epochs)
+  assert(len(epochs) > 0), "Must specify epochs to upsample at with an initial resolution"
+  ratio = final_res/init_res
+  return {
+    epoch: round(init_res * ratio ** ((i+1)/len(epochs))) for i, epoch in enumerate(epochs)
+  }
+
+# epochs at which modules should be upsampled, mapped to [(module, resolution)].
+def upsample_schedule(model, args):
+  upsamples = {}
+  if args.model == "grid" and args.grid_init_res > 0:
+    sched = resolution_schedule(args.grid_init_res, args.grid_res, args.grid_upsample_at)
+    for epoch, res in sched.items(): upsamples.setdefault(epoch, []).append((model.nerf, res))
+  if args.encoder.startswith("tensor") and args.tensor_init_res > 0:
+    encs = [m for m in model.modules() if isinstance(m, TensorEncoder)]
+    sched = resolution_schedule(args.tensor_init_res, args.tensor_res, args.tensor_upsample_at)
+    for epoch, res in sched.items():
+      upsamples.setdefault(epoch, []).extend((enc, res) for enc in encs)
+  return upsamples
+
+# upsamples a module, swapping the parameters it reallocated into the optimizer in place of the
+# old ones. Only their state is reset, and parameters the optimizer did not train stay untrained.
+def upsample_in_opt(opt, module, resolution: int):
+  before = dict(module.named_parameters())
+  module.upsample(resolution)
+  swaps = {
+    id(before[name]): p for name, p in module.named_parameters()
+    if name in before and before[name] is not p
+  }
+  for o in getattr(opt, "optimizers", [opt]):
+    for group in o.param_groups:
+      for i, p in enumerate(group["params"]):
+        if id(p) not in swaps: continue
+        o.state.pop(p, None)
+        group["params"][i] = swaps[id(p)]
+
+# Adam for parameters with dense gradients and SparseAdam for those with sparse gradients, stepped
+# as one optimizer. Their param groups are shared, so learning rate schedules apply to both.
+class SplitAdam(optim.Optimizer):
+  def __init__(self, dense, sparse, lr: float, weight_decay: float = 0, eps: float = 1e-8):
+    self.optimizers = [optim.SparseAdam(sparse, lr=lr, eps=eps)]
+    if len(dense) > 0:
+      self.optimizers.insert(0, optim.Adam(dense, lr=lr, weight_decay=weight_decay, eps=eps))
+    self.defaults = self.optimizers[0].defaults
+    self.param_groups = [g for o in self.optimizers for g in o.param_groups]
+    self.state = {}
+  def zero_grad(self, set_to_none: bool = True):
+    for o in self.optimizers: o.zero_grad(set_to_none=set_to_none)
+  def step(self, closure=None):
+    assert(closure is None), "SplitAdam does not support closures"
+    for o in self.optimizers: o.step()
+  def state_dict(self): return [o.state_dict() for o in self.optimizers]
+  def load_state_dict(self, state_dicts):
+    for o, sd in zip(self.optimizers, state_dicts): o.load_state_dict(sd)
+
+# constructs the optimizer for parameters. Hash tables with --hash-sparse have sparse gradients,
+# which Adam does not support, so they are optimized by SparseAdam, without weight decay.
+def load_optim(model, parameters, args):
+  hash_encs = [m for m in model.modules() if isinstance(m, HashEncoder)]
+  for enc in hash_encs: enc.sparse = args.hash_sparse
+  sparse_ids = set(id(enc.table) for enc in hash_encs if enc.sparse)
+  parameters = list(parameters)
+  dense = [p for p in parameters if id(p) not in sparse_ids]
+  sparse = [p for p in parameters if id(p) in sparse_ids]
+  # for some reason AdamW doesn't seem to work here
+  # eps = 1e-7 was in the original paper.
+  if len(sparse) == 0:
+    return optim.Adam(dense, lr=args.learning_rate, weight_decay=args.decay, eps=1e-7)
+  return SplitAdam(dense, sparse, lr=args.learning_rate, weight_decay=args.decay, eps=1e-7)
+
 # train the model with a given camera and some labels (imgs or imgs+times)
 # light is a per instance light.
 def train(model, cam, labels, opt, args, light=None, sched=None):
@@ -417,6 +744,17 @@ def train(model, cam, labels, opt, args, light=None, sched=None):
   if args.serial_idxs: next_idxs = lambda i: [i%len(cam)] * batch_size
   #next_idxs = lambda i: [i%10] * batch_size # DEBUG
 
+  bank = None
+  if args.ray_bank > 0:
+    assert(args.data_kind != "pixel-single"), "Ray bank does not support per pixel latents"
+    assert(not args.neural_upsample), "Ray bank cannot be used with neural upsampling"
+    # jitters rays as much as render does while training.
+    bank = RayBank(cam, labels, args.render_size, times=times, light=light, noise=0.1)
+
+  upsamples = upsample_schedule(model, args)
+  # fp16 has a small range so gradients are scaled to prevent underflow, bf16 does not need it.
+  scaler = torch.cuda.amp.GradScaler(enabled=args.amp == "fp16")
+
   losses = []
   start = time.time()
   should_end = lambda: False
@@ -429,20 +767,24 @@ def train(model, cam, labels, opt, args, light=None, sched=None):
 
     opt.zero_grad()
 
-    idxs = next_idxs(i)
-
-    ts = None if times is None else times[idxs]
-    c0,c1,c2,c3 = crop = get_crop()
-    ref = labels[idxs][:, c0:c0+c2,c1:c1+c3, :]
-
-    if light is not None: model.refl.light = light[idxs]
+    if bank is None:
+      idxs = next_idxs(i)
+      ts = None if times is None else times[idxs]
+      c0,c1,c2,c3 = crop = get_crop()
+      ref = labels[idxs, c0:c0+c2, c1:c1+c3, :]
+      if light is not None: model.refl.light = light[idxs]
+    else:
+      rays, ref, ts, ray_light = bank.sample(args.ray_bank, args.ray_bank_stratify)
+      if ray_light is not None: model.refl.light = ray_light
 
     # omit items which are all darker with some likelihood. This is mainly used when
     # attempting to focus on learning the refl and not the shape.
     if args.omit_bg and (i % args.save_freq) != 0 and (i % args.valid_freq) != 0 and \
       ref.mean() + 0.3 < sqr(random.random()): continue
 
-    out = render(model, cam[idxs], crop, size=args.render_size, times=ts, args=args)
+    if bank is None:
+      out = render(model, cam[idxs], crop, size=args.render_size, times=ts, args=args)
+    else: out = render_rays(model, rays, args, times=ts)
     loss = loss_fn(out, ref)
     assert(loss.isfinite()), f"Got {loss.item()} loss"
     l2_loss = loss.item()
@@ -464,6 +806,7 @@ def train(model, cam, labels, opt, args, light=None, sched=None):
     if args.sparsify_alpha > 0: loss = loss + args.sparsify_alpha * (model.nerf.alpha).square().mean()
     if args.dnerf_tf_smooth_weight > 0:
       loss = loss + args.dnerf_tf_smooth_weight * model.delta_smoothness
+    if args.grid_tv > 0: loss = loss + args.grid_tv * model.nerf.tv_loss()
 
     # prepare one set of points for either smoothing normals or eikonal.
     if args.sdf_eikonal > 0 or args.smooth_normals > 0:
@@ -497,22 +840,36 @@ def train(model, cam, labels, opt, args, light=None, sched=None):
     losses.append(l2_loss)
 
     assert(loss.isfinite().item()), "Got NaN loss"
-    loss.backward()
-    opt.step()
+    scaler.scale(loss).backward()
+    scaler.step(opt)
+    scaler.update()
     if sched is not None: sched.step()
 
+    if args.occupancy_grid > 0 and i >= args.occupancy_warmup and \
+      (i % args.occupancy_update_freq) == 0:
+      model.nerf.update_occupancy()
+
+    if i in upsamples:
+      for module, res in upsamples[i]: upsample_in_opt(opt, module, res)
+
     if i % args.valid_freq == 0:
       with torch.no_grad():
+        if bank is not None:
+          # rays from the bank are scattered over all images, so render one image to visualize.
+          idx = random.randrange(len(cam))
+          ts = None if times is None else times[idx:idx+1]
+          if light is not None: model.refl.light = light[idx:idx+1]
+          ref = labels[idx:idx+1]
+          chunks = render_chunks(model, cam[idx:idx+1], args.render_size, args, times=ts)
+          out = torch.cat([o for _, _, o in chunks], dim=1)
         ref0 = ref[0,...,:3]
         items = [ref0, out[0,...,:3].clamp(min=0, max=1)]
         if out.shape[-1] == 4:
           items.append(ref[0,...,-1,None].expand_as(ref0))
           items.append(out[0,...,-1,None].expand_as(ref0).sigmoid())
 
-        if args.depth_images and hasattr(model, "nerf"):
-          raw_depth = nerf.volumetric_integrate(
-            model.nerf.weights, model.nerf.ts[:, None, None, None, None]
-          )
+        if args.depth_images and hasattr(model, "nerf") and bank is None:
+          raw_depth = nerf.volumetric_integrate(model.nerf.weights, nerf.expand_ts(model.nerf.ts))
           depth = (raw_depth[0,...]-args.near)/(args.far - args.near)
           items.append(depth.clamp(min=0, max=1))
           if args.normals_from_depth:
@@ -528,80 +885,76 @@ def train(model, cam, labels, opt, args, light=None, sched=None):
 def test(model, cam, labels, args, training: bool = True, light=None):
   times = None
   model = model.eval()
+  march.stats.reset()
   if args.data_kind == "dnerf":
     times = labels[-1]
     labels = labels[0]
 
   ls = []
   gots = []
+  N = labels.shape[0]
+  # when images are small enough, several are rendered in each chunk.
+  n = render_chunk_images(model, args.render_size, args)
   with torch.no_grad():
-    for i in range(labels.shape[0]):
-      ts = None if times is None else times[i:i+1, ...]
-      exp = labels[i,...,:3]
-      got = torch.zeros_like(exp)
+    ii, jj = torch.meshgrid(
+      torch.arange(args.render_size, device=device, dtype=torch.float),
+      torch.arange(args.render_size, device=device, dtype=torch.float),
+    )
+    positions = torch.stack([ii.transpose(-1, -2), jj.transpose(-1, -2)], dim=-1)
+    for i0 in range(0, N, n):
+      i1 = min(i0 + n, N)
+      ts = None if times is None else times[i0:i1, ...]
+      exps = labels[i0:i1,...,:3]
+      got = torch.zeros_like(exps)
       acc = torch.zeros_like(got)
       normals = torch.zeros_like(got)
       depth = torch.zeros(*got.shape[:-1], 1, device=got.device, dtype=torch.float)
       if args.backing_sdf: got_sdf = torch.zeros_like(got)
-      if light is not None: model.refl.light = light[i:i+1]
-
-      ii, jj = torch.meshgrid(
-        torch.arange(args.render_size, device=device, dtype=torch.float),
-        torch.arange(args.render_size, device=device, dtype=torch.float),
-      )
-      positions = torch.stack([ii.transpose(-1, -2), jj.transpose(-1, -2)], dim=-1)
-
-      N = math.ceil(args.render_size/args.crop_size)
-      for x in range(N):
-        for y in range(N):
-          c0 = x * args.crop_size
-          c1 = y * args.crop_size
-          out = render(
-            model, cam[i:i+1, ...], (c0,c1,args.crop_size,args.crop_size), size=args.render_size,
-            with_noise=False, times=ts, args=args,
-          ).squeeze(0)
-          got[c0:c0+args.crop_size, c1:c1+args.crop_size, :] = out
-          if hasattr(model, "nerf"):
-            acc[c0:c0+args.crop_size, c1:c1+args.crop_size, :] = \
-              model.nerf.acc_smooth()[0,...].clamp(min=0,max=1)
-          if hasattr(model, "nerf") and args.depth_images:
-            ts = model.nerf.ts[:, None, None, None, None]
-            depth[c0:c0+args.crop_size, c1:c1+args.crop_size, :] = \
-              nerf.volumetric_integrate(model.nerf.weights, ts)[0,...]
-          if hasattr(model, "n") and hasattr(model, "nerf") :
-            if args.depth_query_normal:
-              positions_crop = positions[c0:c0+args.crop_size, c1:c1+args.crop_size, :]
-              rays = cam.sample_positions(positions_crop, size=args.render_size, with_noise=False)
-              r_o, r_d = torch.squeeze(rays[0,...]).split([3,3], dim=-1)
-              isectpts = r_o + r_d * depth[c0:c0+args.crop_size, c1:c1+args.crop_size, :]
-              normals[c0:c0+args.crop_size, c1:c1+args.crop_size, :] = \
-                (F.normalize(model.sdf.normals(isectpts), dim=-1)+1)/2
-            else:
-              model_n = F.normalize(model.n, dim=-1)
-              render_n = F.normalize(
-                nerf.volumetric_integrate(model.nerf.weights, model_n)[0,...], dim=-1,
-              )
-              normals[c0:c0+args.crop_size, c1:c1+args.crop_size, :] = (render_n+1)/2
-          elif hasattr(model, "n") and hasattr(model, "sdf"):
-            ...
-
-      gots.append(got)
-      loss = F.mse_loss(got, exp)
-      psnr = utils.mse2psnr(loss).item()
-      ts = "" if ts is None else f",t={ts.item():.02f}"
-      print(f"[{i:03}{ts}]: L2 {loss.item():.03f} PSNR {psnr:.03f}")
-      name = f"train_{i:03}.png" if training else f"test_{i:03}.png"
-      name = os.path.join(args.outdir, name)
-      items = [exp, got.clamp(min=0, max=1)]
-      if hasattr(model, "n") and hasattr(model, "nerf"): items.append(normals.clamp(min=0,max=1))
-      if (depth != 0).any() and args.normals_from_depth:
-        depth_normals = (utils.depth_to_normals(depth * 1000)+1)/2
-        items.append(depth_normals)
-      if hasattr(model, "nerf") and args.depth_images:
-        depth = (depth-args.near)/(args.far - args.near)
-        items.append(depth.clamp(min=0, max=1))
-      save_plot(name, *items)
-      ls.append(psnr)
+      if light is not None: model.refl.light = light[i0:i1]
+
+      for r0, r1, out in render_chunks(model, cam[i0:i1, ...], args.render_size, args, times=ts):
+        got[:, r0:r1] = out
+        if hasattr(model, "nerf"):
+          acc[:, r0:r1] = model.nerf.acc_smooth().clamp(min=0,max=1)
+        if hasattr(model, "nerf") and args.depth_images:
+          depth[:, r0:r1] = \
+            nerf.volumetric_integrate(model.nerf.weights, nerf.expand_ts(model.nerf.ts))
+        if hasattr(model, "n") and hasattr(model, "nerf") :
+          if args.depth_query_normal:
+            rays = cam[i0:i1].sample_positions(
+              positions[r0:r1], size=args.render_size, with_noise=False,
+            )
+            r_o, r_d = rays.split([3,3], dim=-1)
+            isectpts = r_o + r_d * depth[:, r0:r1]
+            normals[:, r0:r1] = (F.normalize(model.sdf.normals(isectpts), dim=-1)+1)/2
+          else:
+            model_n = F.normalize(model.n, dim=-1)
+            render_n = F.normalize(nerf.volumetric_integrate(model.nerf.weights, model_n), dim=-1)
+            normals[:, r0:r1] = (render_n+1)/2
+        elif hasattr(model, "n") and hasattr(model, "sdf"):
+          ...
+
+      for j in range(i1 - i0):
+        i = i0 + j
+        exp = exps[j]
+        gots.append(got[j])
+        loss = F.mse_loss(got[j], exp)
+        psnr = utils.mse2psnr(loss).item()
+        t = "" if times is None else f",t={times[i].item():.02f}"
+        print(f"[{i:03}{t}]: L2 {loss.item():.03f} PSNR {psnr:.03f}")
+        name = f"train_{i:03}.png" if training else f"test_{i:03}.png"
+        name = os.path.join(args.outdir, name)
+        items = [exp, got[j].clamp(min=0, max=1)]
+        if hasattr(model, "n") and hasattr(model, "nerf"):
+          items.append(normals[j].clamp(min=0,max=1))
+        if (depth[j] != 0).any() and args.normals_from_depth:
+          depth_normals = (utils.depth_to_normals(depth[j] * 1000)+1)/2
+          items.append(depth_normals)
+        if hasattr(model, "nerf") and args.depth_images:
+          depth_j = (depth[j]-args.near)/(args.far - args.near)
+          items.append(depth_j.clamp(min=0, max=1))
+        save_plot(name, *items)
+        ls.append(psnr)
 
   print(f"""[Summary ({"training" if training else "test"})]:
           mean {np.mean(ls):.03f}
@@ -611,6 +964,7 @@ def test(model, cam, labels, args, training: bool = True, light=None):
   if args.msssim_loss:
     msssim = utils.msssim_loss(gots, refs)
     print(f"\tms-ssim {mssim:.03f}")
+  if args.march_stats: print(f"\tsphere marching: {march.stats.summary()}")
 
 # Sets these parameters on the model on each run, regardless if loaded from previous state.
 def set_per_run(model, args):
@@ -652,7 +1006,8 @@ def load_model(args):
     "mip": mip,
     "out_features": args.feature_space,
     "device": device,
-    "steps": args.steps,
+    "steps": args.steps if args.fine_steps <= 0 else args.coarse_steps,
+    "fine_steps": args.fine_steps,
     "t_near": args.near,
     "t_far": args.far,
     "per_pixel_latent_size": per_pixel_latent_size,
@@ -663,11 +1018,19 @@ def load_model(args):
     "bg": args.bg,
   }
   if args.model == "tiny": constructor = nerf.TinyNeRF
-  elif args.model == "plain": constructor = nerf.PlainNeRF
+  elif args.model == "plain":
+    constructor = nerf.PlainNeRF
+    kwargs["enc"] = load_encoder(args)
   elif args.model == "ae":
     constructor = nerf.NeRFAE
+    kwargs["enc"] = load_encoder(args)
     kwargs["normalize_latent"] = args.normalize_latent
     kwargs["encoding_size"] = args.encoding_size
+  elif args.model == "grid":
+    constructor = nerf.GridNeRF
+    kwargs["resolution"] = args.grid_init_res if args.grid_init_res > 0 else args.grid_res
+    kwargs["bound"] = args.grid_bound
+    kwargs["sh_order"] = args.spherical_harmonic_order
   elif args.model == "volsdf":
     constructor = nerf.VolSDF
     kwargs["sdf"] = sdf.load(args, with_integrator=False)
@@ -678,7 +1041,7 @@ def load_model(args):
   model = constructor(**kwargs).to(device)
 
   # set reflectance kind for new models (but volsdf handles it differently)
-  if args.refl_kind != "curr":
+  if args.refl_kind != "curr" and hasattr(model, "refl"):
     ls = model.refl.latent_size
     refl_inst = refl.load(args, args.refl_kind, args.space_kind, ls).to(device)
     model.set_refl(refl_inst)
@@ -691,7 +1054,7 @@ def load_model(args):
   # Add in a dynamic model if using dnerf with the underlying model.
   if args.data_kind == "dnerf":
     if args.with_canon is not None:
-      model = torch.load(args.with_canon, map_location=device)
+      model = torch.load(args.with_canon, map_location=device, weights_only=False)
       assert(isinstance(model, nerf.CommonNeRF)), f"Can only use NeRF subtype, got {type(model)}"
       assert((not args.dnerfae) or isinstance(model, nerf.NeRFAE)), \
         f"Can only use NeRFAE canonical with DNeRFAE, got {type(model)}"
@@ -731,6 +1094,59 @@ def load_model(args):
   if args.volsdf_alternate: model = nerf.AlternatingVolSDF(model)
   return model
 
+# sets acceleration options on the underlying NeRF for this run, adding an occupancy grid if
+# requested and the model does not already have one.
+def set_acceleration(model, args):
+  canon = getattr(model, "nerf", None)
+  if not isinstance(canon, nerf.CommonNeRF):
+    assert(args.occupancy_grid <= 0 and args.march_chunk <= 0 and not args.packed and \
+      not args.fused_composite and args.shade_eps <= 0 and args.checkpoint == "" and \
+      args.bound_box is None), \
+      f"Acceleration options require a NeRF model, got {type(canon)}"
+    return
+  # the bounding sphere of the SDF also bounds where a NeRF on top of it has any density.
+  canon.set_bounds(args.bound_box, args.bound_sphere_rad)
+  canon.set_march(args.march_chunk, args.min_transmittance, args.march_in_training)
+  canon.set_packed(args.packed)
+  if args.packed and not canon.can_pack:
+    print(f"[warning]: {type(canon).__name__} cannot pack samples, rendering them densely.")
+  canon.set_fused_composite(args.fused_composite)
+  canon.set_shade_eps(args.shade_eps)
+  canon.set_checkpoint(
+    [part for part in args.checkpoint.split(",") if part != ""], args.checkpoint_chunk,
+  )
+  if args.occupancy_grid <= 0 or getattr(canon, "occupancy", None) is not None: return
+  canon.occupancy = OccupancyGrid(
+    resolution=args.occupancy_grid, bound=args.occupancy_bound,
+    threshold=args.occupancy_threshold, device=device,
+  )
+
+# bakes the model into an octree, which is optionally fine-tuned on the training images.
+def bake_octree(model, cam, labels, args, light=None):
+  canon = getattr(model, "nerf", None)
+  assert(isinstance(canon, nerf.CommonNeRF)), f"Can only bake NeRF models, got {type(model)}"
+  # the octree only stores view dependent color, so it cannot be relit or posed in time.
+  assert(light is None), "Cannot bake an octree of a lit dataset"
+  assert(args.data_kind != "dnerf"), "Cannot bake an octree of a dynamic dataset"
+  tree = octree.bake(
+    canon, depth=args.octree_depth, bound=args.octree_bound, sh_order=args.octree_sh_order,
+    threshold=args.octree_threshold, bg=args.bg,
+  )
+  print(f"Baked {tree.num_leaves()} leaves")
+  if args.octree_finetune <= 0:
+    save(tree, argparse.Namespace(**{ **vars(args), "save": args.bake_octree }))
+    return tree
+  opt = optim.Adam(tree.parameters(), lr=args.octree_lr)
+  ft_args = argparse.Namespace(**{
+    **vars(args), "epochs": args.octree_finetune, "save": args.bake_octree,
+    "occupancy_grid": 0, "sparsify_alpha": 0, "latent_l2_weight": 0, "depth_images": False,
+    "grid_tv": 0, "grid_init_res": 0, "tensor_init_res": 0,
+    # losses on the SDF or deformation of the original model, which the octree does not have.
+    "sdf_eikonal": 0, "smooth_normals": 0, "backing_sdf": False, "dnerf_tf_smooth_weight": 0,
+  })
+  train(tree, cam, labels, opt, ft_args)
+  return tree
+
 def save(model, args):
   if args.nosave: return
   print(f"Saved to {args.save}")
@@ -754,16 +1170,9 @@ def sphere_visualize(args, model):
       )
 
       got = torch.zeros(args.render_size, args.render_size, 3, device=device)
-      N = math.ceil(args.render_size/args.crop_size)
-      for x in range(N):
-        for y in range(N):
-          c0 = x * args.crop_size
-          c1 = y * args.crop_size
-          out = render(
-            model, cam[i:i+1, ...], (c0,c1,args.crop_size,args.crop_size), size=args.render_size,
-            with_noise=False, args=args,
-          ).squeeze(0)
-          got[c0:c0+args.crop_size, c1:c1+args.crop_size, :] = out
+      with torch.no_grad():
+        for r0, r1, out in render_chunks(model, cam[i:i+1, ...], args.render_size, args):
+          got[r0:r1] = out[0]
       save_image(os.path.join(args.outdir, f"visualize_{i:03}_{j:03}.png"), got)
 
 
@@ -780,31 +1189,40 @@ def main():
   labels, cam, light = loaders.load(args, training=True, device=device)
   if args.train_imgs > 0:
     if type(labels) == tuple: labels = tuple(l[:args.train_imgs, ...] for l in labels)
+    elif isinstance(labels, loaders.HostLabels):
+      labels = labels.narrow(0, 0, min(args.train_imgs, len(labels)))
     else: labels = labels[:args.train_imgs, ...]
     cam = cam[:args.train_imgs, ...]
+  labels = loaders.store_labels(labels, args, device)
 
-  model = load_model(args) if args.load is None else torch.load(args.load, map_location=device)
+  model = load_model(args) if args.load is None else torch.load(args.load, map_location=device, weights_only=False)
   set_per_run(model, args)
+  if args.estimate_bound_box:
+    args.bound_box = loaders.estimate_scene_box(
+      labels, cam, args.near, args.far, res=args.bound_box_res, margin=args.bound_box_margin,
+    )
+    print(f"Estimated bounding box: {[round(v, 3) for v in args.bound_box]}")
+  set_acceleration(model, args)
 
   if args.train_parts == "all": parameters = model.parameters()
   elif args.train_parts == "refl": parameters = model.refl.parameters()
   elif args.train_parts == "camera": raise NotImplementedError("TODO")
   else: raise NotImplementedError()
 
-  # for some reason AdamW doesn't seem to work here
-  # eps = 1e-7 was in the original paper.
-  opt = optim.Adam(parameters, lr=args.learning_rate, weight_decay=args.decay, eps=1e-7)
+  opt = load_optim(model, parameters, args)
 
   # TODO should T_max = -1 or args.epochs
   sched = optim.lr_scheduler.CosineAnnealingLR(opt, T_max=args.epochs, eta_min=5e-5)
   if args.no_sched: sched = None
   train(model, cam, labels, opt, args, light=light, sched=sched)
 
+  if args.bake_octree is not None: model = bake_octree(model, cam, labels, args, light=light)
 
   if not args.notraintest: test(model, cam, labels, args, training=True, light=light)
 
   if args.notest: return
   test_labels, test_cam, test_light = loaders.load(args, training=False, device=device)
+  test_labels = loaders.store_labels(test_labels, args, device)
   test(model, test_cam, test_labels, args, training=False, light=test_light)
 
   if args.sphere_visualize is not None:
@@ -1,17 +1,49 @@
+import functools
 import math
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from dataclasses import dataclass
+from dataclasses import ( dataclass, fields )
 from .utils import rotate_vector
 from .neural_blocks import ( SkipConnMLP )
 import random
 
+# [size, size, 2] screen space position of every pixel of an image.
+# Cached, so callers must not modify it in place.
+@functools.lru_cache(maxsize=8)
+def pixel_grid(size: int, device="cuda"):
+  ii, jj = torch.meshgrid(
+    torch.arange(size, device=device, dtype=torch.float),
+    torch.arange(size, device=device, dtype=torch.float),
+  )
+  return torch.stack([ii.transpose(-1, -2), jj.transpose(-1, -2)], dim=-1)
+
+# [size, size, 3] camera space direction of every pixel of a pinhole camera.
+@functools.lru_cache(maxsize=16)
+def camera_dirs(size: int, focal: float, device="cuda"):
+  u, v = pixel_grid(size, device).split([1,1], dim=-1)
+  return torch.cat([
+    (u - size * 0.5) / focal, -(v - size * 0.5) / focal, -torch.ones_like(u),
+  ], dim=-1)
+
 # General Camera interface
 @dataclass
 class Camera(nn.Module):
   # samples from positions in [0,size] screen space to global
   def sample_positions(self, positions): raise NotImplementedError()
+  # samples rays for a crop (top, left, height, width) of an image. Cameras may override this to
+  # reuse whatever does not depend on their pose between calls.
+  def sample_crop(self, crop, size: int, with_noise=False, device="cuda"):
+    t,l,h,w = crop
+    positions = pixel_grid(size, device)[t:t+h, l:l+w]
+    return self.sample_positions(positions, size=size, with_noise=with_noise)
+
+# moves every tensor of a camera to device
+def to_device(cam, device):
+  kwargs = { f.name: getattr(cam, f.name) for f in fields(cam) }
+  kwargs = { k: v.to(device) if torch.is_tensor(v) else v for k, v in kwargs.items() }
+  if "device" in kwargs: kwargs["device"] = device
+  return type(cam)(**kwargs)
 
 # A camera made specifically for generating rays from NeRF models
 @dataclass
@@ -60,6 +92,19 @@ class NeRFCamera(Camera):
     r_o = self.cam_to_world[..., :3, -1][:, None, None, :].expand_as(r_d)
     return torch.cat([r_o, r_d], dim=-1)
 
+  # same as sample_positions, but rotates cached camera space directions.
+  def sample_crop(self, crop, size: int, with_noise=False, device="cuda"):
+    if torch.is_tensor(self.focal): return super().sample_crop(crop, size, with_noise, device)
+    c2w = self.cam_to_world
+    t,l,h,w = crop
+    d = camera_dirs(size, float(self.focal), c2w.device)[t:t+h, l:l+w]
+    if with_noise:
+      uv = (torch.rand(h, w, 2, device=c2w.device) - 0.5) * with_noise / self.focal
+      d = d + torch.stack([uv[..., 0], -uv[..., 1], torch.zeros_like(uv[..., 0])], dim=-1)
+    r_d = torch.einsum("hwj,bij->bhwi", d, c2w[..., :3, :3])
+    r_o = c2w[..., :3, -1][:, None, None, :].expand_as(r_d)
+    return torch.cat([r_o, r_d], dim=-1)
+
 def vec2skew(v):
   zero = torch.zeros(v.shape[:-1] + (1,), device=v.device, dtype=v.dtype)
   return torch.stack([
@@ -160,6 +205,16 @@ class NeRFMMCamera(Camera):
     r_o = self.t[:, None, None, :].expand_as(r_d)
     return torch.cat([r_o, r_d], dim=-1)
 
+  # same as sample_positions, but scales cached directions by the learned focals.
+  def sample_crop(self, crop, size: int, with_noise=False, device="cuda"):
+    if with_noise: return super().sample_crop(crop, size, with_noise, device)
+    t,l,h,w = crop
+    d = camera_dirs(size, 1., self.t.device)[t:t+h, l:l+w]
+    d = d / torch.cat([self.focals, torch.ones_like(self.focals[..., :1])], dim=-1)
+    r_d = F.normalize(torch.einsum("hwj,bij->bhwi", d, exp(self.r)), dim=-1)
+    r_o = self.t[:, None, None, :].expand_as(r_d)
+    return torch.cat([r_o, r_d], dim=-1)
+
 # learned time varying camera
 class NeRFMMTimeCamera(Camera):
   def __init__(
@@ -263,3 +318,28 @@ class DTUCamera(Camera):
 
     return torch.cat([r_o, r_d], dim=-1).reshape(N, W, H, 6)
 
+  # same as sample_positions, but rotates camera space directions cached for each intrinsic.
+  def sample_crop(self, crop, size: int, with_noise=False, device="cuda"):
+    pose = self.pose
+    assert(pose.shape[1] != 7), "Quaternion poses are not supported"
+    t,l,h,w = crop
+    # intrinsics are small, so they are read back to key the cache.
+    d = torch.stack([
+      dtu_dirs(size, tuple(k), pose.device)[t:t+h, l:l+w]
+      for k in self.intrinsic.reshape(len(self), -1).tolist()
+    ], dim=0)
+    r_d = F.normalize(torch.einsum("bhwj,bij->bhwi", d, pose[:, :3, :3]), dim=-1)
+    r_o = pose[:, None, None, :3, 3].expand_as(r_d)
+    return torch.cat([r_o, r_d], dim=-1)
+
+# [size, size, 3] camera space direction of every pixel of a DTU camera with a flattened 4x4
+# intrinsic matrix.
+@functools.lru_cache(maxsize=128)
+def dtu_dirs(size: int, intrinsic: tuple, device="cuda"):
+  intrinsic = torch.tensor(intrinsic, device=device, dtype=torch.float).reshape(1, 4, 4)
+  normalize = torch.tensor([1600, 1200], device=device, dtype=torch.float)/size
+  u, v = (pixel_grid(size, device) * normalize).reshape(1, -1, 2).split([1,1], dim=-1)
+  u, v = u.squeeze(-1), v.squeeze(-1)
+  return lift(u, v, torch.ones_like(u), intrinsics=intrinsic, size=size)[0, :, :3]\
+    .reshape(size, size, 3)
+
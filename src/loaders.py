@@ -3,8 +3,14 @@
 # from the returned type
 # Loader(...) -> Labels, Camera, Optional<Lights>
 
+import hashlib
 import json
+import math
 import os
+import queue
+import tempfile
+import threading
+from concurrent.futures import ( ThreadPoolExecutor )
 
 import torch
 import torch.nn.functional as F
@@ -25,35 +31,55 @@ def load(args, training=True, device="cuda"):
     if args.data.endswith(".mp4"): kind = "single_video"
     elif args.data.endswith(".jpg"): kind = "pixel-single"
 
+  if getattr(args, "label_storage", "device") != "device" and device != "cpu":
+    assert(kind in ["original", "nerv_point", "dtu", "dnerf", "single_video"]), \
+      f"Cannot keep labels on the host for {kind}"
+    # load everything on the host, and only move cameras and lights to the device.
+    labels, cam, light = load(args, training=training, device="cpu")
+    if type(labels) == tuple: labels = (labels[0], labels[1].to(device))
+    return labels, cameras.to_device(cam, device), None if light is None else light.to(device)
+
   with_mask = (args.model == "sdf" or args.volsdf_alternate) and training
   size = args.size
+  cache_dir = getattr(args, "data_cache", None)
+  workers = getattr(args, "load_workers", 8)
+  key = {
+    "kind": kind, "training": training, "size": size, "with_mask": with_mask,
+    "white_bg": args.bg == "white",
+  }
   if kind == "original":
-    return original(
+    return cached(cache_dir, args.data, key, device, lambda: original(
       args.data, training=training, normalize=False, size=size,
       white_bg=args.bg=="white",
       with_mask = with_mask,
-      device=device,
-    )
+      device=device, workers=workers,
+    ))
   elif kind == "nerv_point":
-    return nerv_point(
+    key["multi_point"] = args.nerv_multi_point
+    return cached(cache_dir, args.data, key, device, lambda: nerv_point(
       args.data, training=training, size=size,
       with_mask = with_mask,
       multi_point = args.nerv_multi_point,
-      device=device,
-    )
+      device=device, workers=workers,
+    ))
   elif kind == "dtu":
-    return dtu(
+    return cached(cache_dir, args.data, key, device, lambda: dtu(
       args.data, training=training, size=size,
       with_mask = with_mask,
-      device=device,
-    )
+      device=device, workers=workers,
+    ))
   elif kind == "dnerf":
-    return dnerf(
+    key["time_gamma"] = args.time_gamma
+    return cached(cache_dir, args.data, key, device, lambda: dnerf(
       args.data, training=training, size=size, time_gamma=args.time_gamma,
-      white_bg=args.bg=="white", device=device,
-    )
+      white_bg=args.bg=="white", device=device, workers=workers,
+    ))
   elif kind == "single_video":
-    return single_video(args.data)
+    return single_video(
+      args.data, training=training, size=size, device=device,
+      start=args.video_start, end=args.video_end, stride=args.video_stride,
+      storage=getattr(args, "label_storage", "device"), max_mb=getattr(args, "video_max_mb", 4096),
+    )
   elif kind == "pixel-single":
     img, cam = single_image(args.data)
     setattr(args, "img", img)
@@ -64,26 +90,201 @@ def load(args, training=True, device="cuda"):
     raise NotImplementedError()
   else: raise NotImplementedError(f"load data: {kind}")
 
+# Labels [I, H, W, C] kept in host memory, either in RAM or in a memory mapped file, and possibly
+# quantized. Only the indexed part is transferred to the device and converted to float32.
+# Indexed items are gathered straight into a pinned staging buffer, since indexing pageable memory
+# would allocate a pageable copy which cannot be transferred asynchronously.
+class HostLabels:
+  def __init__(self, data, device="cuda", scale: float = 1, storage: str = "host"):
+    self.data = data
+    self.device = device
+    self.scale = scale
+    self.storage = storage
+    self.pinned = torch.cuda.is_available() and torch.device(device).type == "cuda"
+    # two staging buffers alternate, so one can be filled while the other is still transferring.
+    self.staging = [None, None]
+    self.copied = [None, None]
+    self.turn = 0
+  @classmethod
+  def store(cls, labels, storage: str = "host", dtype: str = "float32", device="cuda"):
+    scale = 1
+    if dtype == "uint8":
+      scale = 1/255
+      if labels.dtype != torch.uint8:
+        labels = (labels * 255).round().clamp(min=0, max=255).to(torch.uint8)
+    elif dtype == "float16": labels = labels.half()
+    else: labels = labels.float()
+    labels = labels.cpu().contiguous()
+    if storage == "mmap":
+      # anonymous file which is removed when the process exits.
+      mmap = np.memmap(
+        tempfile.TemporaryFile(), mode="w+", shape=tuple(labels.shape),
+        dtype=labels.numpy().dtype,
+      )
+      mmap[:] = labels.numpy()
+      labels = torch.from_numpy(mmap)
+    elif storage != "host": raise NotImplementedError(f"label storage: {storage}")
+    return cls(labels, device=device, scale=scale, storage=storage)
+
+  @property
+  def shape(self): return self.data.shape
+  def __len__(self): return self.data.shape[0]
+  def reshape(self, *shape):
+    return HostLabels(self.data.reshape(*shape), self.device, self.scale, self.storage)
+  def narrow(self, dim: int, start: int, length: int):
+    return HostLabels(self.data.narrow(dim, start, length), self.device, self.scale, self.storage)
+
+  # returns a pinned tensor of this shape, backed by the next staging buffer.
+  def stage(self, shape):
+    i = self.turn = 1 - self.turn
+    # the buffer may still be in use by the transfer from two calls ago.
+    if self.copied[i] is not None: self.copied[i].synchronize()
+    n = math.prod(shape)
+    if self.staging[i] is None or self.staging[i].numel() < n:
+      self.staging[i] = torch.empty(n, dtype=self.data.dtype).pin_memory()
+    return self.staging[i][:n].view(shape)
+
+  def __getitem__(self, idx):
+    if type(idx) != tuple: idx = (idx,)
+    items, rest = idx[0], idx[1:]
+    if items is Ellipsis: items, rest = slice(None), idx
+    # slicing the host labels is free, so crop each image first and only gather what is used.
+    src = self.data[(slice(None),) + rest] if len(rest) > 0 else self.data
+    if type(items) == list or torch.is_tensor(items):
+      items = torch.as_tensor(items).cpu()
+      if items.dtype == torch.bool: items = items.nonzero()[:, 0]
+      shape = (items.numel(),) + tuple(src.shape[1:])
+      if self.pinned: src = torch.index_select(src, 0, items, out=self.stage(shape))
+      else: src = torch.index_select(src, 0, items)
+    else:
+      src = src[items]
+      if self.pinned: src = self.stage(tuple(src.shape)).copy_(src)
+    out = src.to(self.device, non_blocking=True)
+    if self.pinned:
+      self.copied[self.turn] = torch.cuda.Event()
+      self.copied[self.turn].record()
+    out = out.float()
+    return out if self.scale == 1 else out * self.scale
+
+# wraps loaded labels (imgs or imgs+times) for --label-storage, leaving them as is on the device.
+def store_labels(labels, args, device="cuda"):
+  storage = getattr(args, "label_storage", "device")
+  if isinstance(labels, HostLabels):
+    # already on the host, such as uint8 video frames, which are kept as uint8.
+    if storage == "device" or storage == labels.storage: return labels
+    dtype = "uint8" if labels.data.dtype == torch.uint8 else args.label_dtype
+    return HostLabels.store(labels.data, storage, dtype, device)
+  if storage == "device": return labels
+  if type(labels) == tuple:
+    return (HostLabels.store(labels[0], storage, args.label_dtype, device),) + labels[1:]
+  return HostLabels.store(labels, storage, args.label_dtype, device)
+
+# Estimates a tight box (x0, y0, z0, x1, y1, z1) around the scene by carving a grid of points
+# with every camera's frustum between near and far, and with its alpha mask if labels have one.
+# Points which some camera does not see, or sees outside of its mask, cannot be in the scene.
+# Geometry which is only partially in view of some camera would be cut off by its frustum, so the
+# box is padded on each side by margin times its size.
+@torch.no_grad()
+def estimate_scene_box(
+  labels, cam, near: float, far: float, res: int = 64, margin: float = 0.1,
+):
+  assert(isinstance(cam, cameras.NeRFCamera)), "Can only estimate a box for NeRF cameras"
+  if type(labels) == tuple: labels = labels[0]
+  c2w = cam.cam_to_world
+  device = c2w.device
+  size = labels.shape[1]
+  origins = c2w[:, :3, 3]
+  lo, hi = origins.min(dim=0)[0] - far, origins.max(dim=0)[0] + far
+  axes = [torch.linspace(0, 1, res, device=device)] * 3
+  grid = torch.stack(torch.meshgrid(*axes), dim=-1).reshape(-1, 3)
+  pts = lo + grid * (hi - lo)
+  keep = torch.ones(pts.shape[0], dtype=torch.bool, device=device)
+  for i in range(len(cam)):
+    # into camera space, where the camera looks down -z. Since ray directions have z = -1,
+    # depth is also the distance along the ray which near and far bound.
+    local = (pts - c2w[i, :3, 3]) @ c2w[i, :3, :3]
+    depth = -local[:, 2]
+    u = cam.focal * local[:, 0]/depth.clamp(min=1e-5) + size * 0.5
+    v = size * 0.5 - cam.focal * local[:, 1]/depth.clamp(min=1e-5)
+    keep &= (depth >= max(near, 1e-5)) & (depth <= far) & \
+      (u >= 0) & (u < size) & (v >= 0) & (v < size)
+    if labels.shape[-1] == 4:
+      col = u.long().clamp(min=0, max=size-1)
+      row = v.long().clamp(min=0, max=size-1)
+      keep &= labels[i][row, col, 3].to(device) > 0
+  assert(keep.any()), "No point is seen by every camera, cannot estimate a scene box"
+  kept = pts[keep]
+  box_lo, box_hi = kept.min(dim=0)[0], kept.max(dim=0)[0]
+  pad = (hi - lo)/(res - 1) + margin * (box_hi - box_lo)
+  return torch.cat([box_lo - pad, box_hi + pad]).tolist()
+
+# applies fn to each item using a pool of threads, returning outputs in the same order. Decoding
+# and resizing images mostly releases the GIL, so threads are enough to decode in parallel.
+def parallel_map(fn, items, workers: int = 8):
+  items = list(items)
+  if workers <= 1 or len(items) <= 1: return [fn(item) for item in items]
+  with ThreadPoolExecutor(max_workers=workers) as pool: return list(pool.map(fn, items))
+
+# Names a dataset by the loader's arguments and the size and modification time of every file
+# under its path, so that editing, adding or removing any file gives a new name.
+def cache_key(path, key, cache_dir) -> str:
+  files = []
+  for root, dirs, names in os.walk(path):
+    # the cache may be inside of the dataset, but should not change its name.
+    dirs[:] = [d for d in dirs if not os.path.samefile(os.path.join(root, d), cache_dir)]
+    for name in names:
+      f = os.path.join(root, name)
+      stat = os.stat(f)
+      files.append((os.path.relpath(f, path), stat.st_size, stat.st_mtime_ns))
+  desc = json.dumps([os.path.abspath(path), key, sorted(files)], sort_keys=True)
+  return hashlib.sha1(desc.encode()).hexdigest()
+
+# Caches the output of load_fn in cache_dir, with labels stored as a .npy file which later runs
+# memory map instead of decoding every image again. Does nothing if cache_dir is None.
+def cached(cache_dir, path, key, device, load_fn):
+  if cache_dir is None: return load_fn()
+  os.makedirs(cache_dir, exist_ok=True)
+  entry = os.path.join(cache_dir, cache_key(path, key, cache_dir))
+  labels_file = os.path.join(entry, "labels.npy")
+  meta_file = os.path.join(entry, "meta.pt")
+  if os.path.exists(meta_file):
+    # copy on write, so that the labels can still be modified in place without touching the file.
+    imgs = torch.from_numpy(np.load(labels_file, mmap_mode="c")).to(device)
+    # cam and light are pickled modules, which torch >= 2.6 only loads with weights_only off.
+    meta = torch.load(meta_file, map_location=device, weights_only=False)
+    labels = imgs if meta["times"] is None else (imgs, meta["times"])
+    return labels, meta["cam"], meta["light"]
+
+  labels, cam, light = load_fn()
+  imgs, times = labels if type(labels) == tuple else (labels, None)
+  os.makedirs(entry, exist_ok=True)
+  # write to temporaries first so that an interrupted run never leaves a partial entry.
+  np.save(labels_file + ".tmp.npy", imgs.detach().float().cpu().numpy())
+  os.replace(labels_file + ".tmp.npy", labels_file)
+  torch.save({ "times": times, "cam": cam, "light": light }, meta_file + ".tmp")
+  os.replace(meta_file + ".tmp", meta_file)
+  return labels, cam, light
+
 
 def original(
   dir=".", normalize=True, training=True, size=256, white_bg=False, with_mask=False,
-  device="cuda",
+  device="cuda", workers: int = 8,
 ):
   kind = "train" if training else "test"
   tfs = json.load(open(dir + f"transforms_{kind}.json"))
   channels = 3 + with_mask
 
-  exp_imgs = []
-  cam_to_worlds = []
-  focal = 0.5 * size / np.tan(0.5 * float(tfs['camera_angle_x']))
-  for i, frame in enumerate(tfs["frames"]):
-    fp = frame['file_path']
-    if fp == "":
-      # have to special case empty since nerfactor didn't fill in their blanks
-      fp = f"test_{i:03}/nn"
+  def load_frame(fp):
     img = load_image(os.path.join(dir, fp + '.png'), resize=(size, size))
     if white_bg: img = img[..., :3]*img[..., -1:] + (1-img[..., -1:])
-    exp_imgs.append(img[..., :channels])
+    return img[..., :channels]
+  # have to special case empty since nerfactor didn't fill in their blanks
+  fps = [frame['file_path'] or f"test_{i:03}/nn" for i, frame in enumerate(tfs["frames"])]
+  exp_imgs = parallel_map(load_frame, fps, workers)
+
+  cam_to_worlds = []
+  focal = 0.5 * size / np.tan(0.5 * float(tfs['camera_angle_x']))
+  for frame in tfs["frames"]:
     tf_mat = torch.tensor(frame['transform_matrix'], dtype=torch.float, device=device)[:3, :4]
     if normalize: tf_mat[:3, 3] = F.normalize(tf_mat[:3, 3], dim=-1)
     cam_to_worlds.append(tf_mat)
@@ -98,20 +299,22 @@ def original(
 def dnerf(
   dir=".", normalize=False, training=True,
   size=256, time_gamma=True, white_bg=False,
-  device="cuda"
+  device="cuda", workers: int = 8,
 ):
   kind = "train" if training else "test"
   tfs = json.load(open(dir + f"transforms_{kind}.json"))
-  exp_imgs = []
   cam_to_worlds = []
   times = []
 
+  def load_frame(frame):
+    img = load_image(os.path.join(dir, frame['file_path'] + '.png'), resize=(size, size))
+    if white_bg: img = img[..., :3] * img[..., -1:] + (1-img[..., -1:])
+    return img[..., :3]
+  exp_imgs = parallel_map(load_frame, tfs["frames"], workers)
+
   focal = 0.5 * size / np.tan(0.5 * float(tfs['camera_angle_x']))
   n_frames = len(tfs["frames"])
   for t, frame in enumerate(tfs["frames"]):
-    img = load_image(os.path.join(dir, frame['file_path'] + '.png'), resize=(size, size))
-    if white_bg: img = img[..., :3] * img[..., -1:] + (1-img[..., -1:])
-    exp_imgs.append(img[..., :3])
     tf_mat = torch.tensor(frame['transform_matrix'], dtype=torch.float, device=device)[:3, :4]
     if normalize:
       tf_mat[:3, 3] = F.normalize(tf_mat[:3, 3], dim=-1)
@@ -132,27 +335,22 @@ def dnerf(
 
   return (exp_imgs, times), cameras.NeRFCamera(cam_to_worlds, focal), None
 
-def dtu(path=".", training=True, size=256, with_mask=False, device="cuda"):
+def dtu(path=".", training=True, size=256, with_mask=False, device="cuda", workers: int = 8):
   import cv2
 
-  num_imgs = 0
-  exp_imgs = []
-  image_dir = os.path.join(path, "image")
-  for f in sorted(os.listdir(image_dir)):
-    if f.startswith("._"): continue
-    num_imgs += 1
-    img = load_image(os.path.join(image_dir, f), resize=(size, size)).to(device)
-    exp_imgs.append(img)
+  def list_dir(d):
+    return [os.path.join(d, f) for f in sorted(os.listdir(d)) if not f.startswith("._")]
+  img_files = list_dir(os.path.join(path, "image"))
+  num_imgs = len(img_files)
+  mask_files = list_dir(os.path.join(path, "mask")) if with_mask else []
+  # images and masks are decoded by the same pool so that they load concurrently.
+  load = lambda f: load_image(f, resize=(size, size))
+  decoded = parallel_map(load, img_files + mask_files, workers)
 
-  exp_imgs = torch.stack(exp_imgs, dim=0).to(device)
+  exp_imgs = torch.stack(decoded[:num_imgs], dim=0).to(device)
 
   if with_mask:
-    exp_masks = []
-    mask_dir = os.path.join(path, "mask")
-    for f in sorted(os.listdir(mask_dir)):
-      if f.startswith("._"): continue
-      mask = load_image(os.path.join(mask_dir, f), resize=(size, size)).to(device)
-      exp_masks.append(mask.max(dim=-1)[0].ceil())
+    exp_masks = [mask.max(dim=-1)[0].ceil() for mask in decoded[num_imgs:]]
     exp_masks = torch.stack(exp_masks, dim=0).to(device)
     exp_imgs = torch.cat([exp_imgs, exp_masks], dim=-1)
 
@@ -179,9 +377,17 @@ def dtu(path=".", training=True, size=256, with_mask=False, device="cuda"):
   return exp_imgs, cameras.DTUCamera(pose=poses, intrinsic=intrinsics), None
 
 # https://docs.google.com/document/d/1KI7YtWl3nAuS6xH2WFWug87o-1G6PP4GHrnNzZ0LeUk/edit
-def nerv_point(path=".", training=True, size=200, multi_point=False, with_mask=False, device="cuda"):
+def nerv_point(
+  path=".", training=True, size=200, multi_point=False, with_mask=False, device="cuda",
+  workers: int = 8,
+):
   import imageio
-  def load_exr(path): return torch.from_numpy(imageio.imread(path))
+  def load_exr(path): return torch.from_numpy(np.asarray(imageio.imread(path), dtype=np.float32))
+  def load_frame(frame):
+    img = load_exr(os.path.join(path, frame['file_path'] + '.exr')).permute(2,0,1)
+    img = TVF.resize(img, size=(size, size))
+    img[:3,...] = TVF.adjust_gamma(img[:3,...].clamp(min=1e-10), 1/2.2)
+    return img.permute(1,2,0)
 
   if training: path = path + f"train_point/"
   kind = "train" if training else "test"
@@ -195,11 +401,7 @@ def nerv_point(path=".", training=True, size=200, multi_point=False, with_mask=F
 
   frames = tfs["frames"]
   frames = frames[:100] if not multi_point else frames[100:]
-  for frame in frames:
-    img = load_exr(os.path.join(path, frame['file_path'] + '.exr')).permute(2,0,1)
-    img = TVF.resize(img, size=(size, size))
-    img[:3,...] = TVF.adjust_gamma(img[:3,...].clamp(min=1e-10), 1/2.2)
-    img = img.permute(1,2,0)
+  for frame, img in zip(frames, parallel_map(load_frame, frames, workers)):
     exp_imgs.append(img[..., :3])
     exp_masks.append((img[..., 3] - 1e-5).ceil())
     tf_mat = torch.tensor(frame['transform_matrix'], dtype=torch.float, device=device)[:3, :4]
@@ -256,10 +458,93 @@ def shiny(path, training=True, size=256, device="cuda"):
   raise NotImplementedError("TODO get camera from poses, bds")
   return imgs, cameras.NeRFCamera(poses, focal=fx), None
 
-def single_video(path, training=True, size=256, device="cuda"):
-  frames, _, _ = torchvision.io.read_video(path, pts_unit='sec')
-  frames = (frames[:100]/255).to(device)
-  return frames, cameras.NeRFMMCamera.identity(len(frames), device=device), None
+# Decodes frames [start, end) of a video with a stride on a background thread, resizing each as
+# it is decoded. Decoding starts from the keyframe before start, and up to queue_size decoded
+# frames are buffered ahead of the consumer, so frames outside of the range are never kept.
+class VideoStream:
+  def __init__(
+    self, path, start: int = 0, end: int = -1, stride: int = 1, size=None, queue_size: int = 32,
+  ):
+    assert(stride > 0), "Video stride must be positive"
+    self.path = path
+    self.start = start
+    self.end = end
+    self.stride = stride
+    self.size = size
+    self.queue_size = queue_size
+
+  def decode(self, out, stop):
+    # waits for space in the queue, giving up once the consumer stopped iterating.
+    def put(item):
+      while not stop.is_set():
+        try:
+          out.put(item, timeout=0.1)
+          return True
+        except queue.Full: continue
+      return False
+    try:
+      reader = torchvision.io.VideoReader(self.path, "video")
+      fps = reader.get_metadata()["video"]["fps"][0]
+      # seeking may land on an earlier keyframe, so frames are numbered by their timestamp.
+      if self.start > 0: reader.seek(self.start / fps)
+      for frame in reader:
+        i = round(frame["pts"] * fps)
+        if self.end >= 0 and i >= self.end: break
+        # skipped frames are dropped as decoded, without being resized or copied.
+        if i < self.start or (i - self.start) % self.stride != 0: continue
+        # [3, H, W] uint8
+        img = frame["data"]
+        if self.size is not None: img = TVF.resize(img, size=(self.size, self.size))
+        if not put(img.permute(1,2,0)): return
+      put(None)
+    except Exception as e: put(e)
+
+  # yields [H, W, 3] uint8 frames in order. Closing the iterator early stops the decoder.
+  def __iter__(self):
+    out = queue.Queue(maxsize=self.queue_size)
+    stop = threading.Event()
+    threading.Thread(target=self.decode, args=(out, stop), daemon=True).start()
+    try:
+      while True:
+        frame = out.get()
+        if frame is None: return
+        if isinstance(frame, Exception): raise frame
+        yield frame
+    finally: stop.set()
+
+# Frames stay uint8 on the host, and are only transferred and scaled per batch. With mmap storage
+# they are written to a file as they are decoded and paged in as training reads them, otherwise
+# they are kept in RAM, which is capped at max_mb.
+def single_video(
+  path, training=True, size=256, device="cuda", start: int = 0, end: int = 100, stride: int = 1,
+  storage: str = "host", max_mb: float = 4096,
+):
+  stream = VideoStream(path, start, end, stride, size)
+  n = 0
+  if storage == "mmap":
+    # anonymous file which is removed when the process exits.
+    f = tempfile.TemporaryFile()
+    for frame in stream:
+      f.write(frame.contiguous().numpy().data)
+      n += 1
+    f.flush()
+    if n > 0:
+      data = np.memmap(f, mode="r+", shape=(n, size, size, 3), dtype=np.uint8)
+      data = torch.from_numpy(data)
+  else:
+    frames = []
+    for frame in stream:
+      frames.append(frame)
+      n += 1
+      # frames are stacked at the end, which briefly needs twice their size.
+      assert(2 * n * frame.numel() <= max_mb * (1 << 20)), \
+        f"Frames of {path} exceed --video-max-mb {max_mb}, use --label-storage mmap, " \
+        "a larger --video-stride or an earlier --video-end"
+    if n > 0: data = torch.stack(frames, dim=0)
+  assert(n > 0), f"No frames decoded from {path} in [{start}, {end})"
+  storage = "mmap" if storage == "mmap" else "host"
+  frames = HostLabels(data, device=device, scale=1/255, storage=storage)
+  return frames, cameras.NeRFMMCamera.identity(n, device=device), None
 
 def single_image(path, training=True, size=256, device="cuda"):
   img = torchvision.io.read_image(path).to(device)
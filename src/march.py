@@ -11,38 +11,177 @@ def load_intersection_kind(kind):
   if kind == "sphere": return sphere_march
   if kind == "secant": return secant
   if kind == "bisect": return bisect
-  # TODO first intersect with sphere marching using small # of iters,
+  # first intersect with sphere marching using small # of iters,
   # then intersect with bisection/secant. Seems to work for IDR (and PhySG which took from IDR)
-  if kind == "march": raise NotImplementedError("")
+  if kind == "march": return hybrid
 
   raise NotImplementedError(f"unknown intersection kind {kind}")
 
+# Number of rays still being marched at each iteration of sphere_march, summed over all calls
+# since the last reset. Useful for choosing how many iterations to march for.
+class MarchStats:
+  def __init__(self): self.reset()
+  def reset(self):
+    self.calls = 0
+    self.active = []
+  def record(self, counts):
+    self.calls += 1
+    self.active.extend([0] * (len(counts) - len(self.active)))
+    for i, c in enumerate(counts): self.active[i] += c
+  def summary(self) -> str:
+    if self.calls == 0: return "no rays marched"
+    mean = [c/self.calls for c in self.active]
+    first = mean[0] if len(mean) > 0 else 0
+    # report how many iterations it takes for most rays to finish.
+    pct = lambda p: next((i for i, c in enumerate(mean) if c <= first * (1 - p)), len(mean))
+    return f"{self.calls} calls, {first:.0f} rays, {len(mean)} iters used, " + \
+      f"90% done by iter {pct(0.9)}, 99% done by iter {pct(0.99)}"
+stats = MarchStats()
+
+# evaluates the SDF on pts [N, 3] in chunks of at most chunk_size points.
+def chunked_sdf(self, pts, chunk_size: int):
+  if chunk_size <= 0 or pts.shape[0] <= chunk_size: return self(pts)[..., 0]
+  return torch.cat([self(chunk)[..., 0] for chunk in pts.split(chunk_size, dim=0)], dim=0)
+
 # sphere_march is a traditional sphere marching algorithm on the SDF.
 # It returns the (pts: R^3s, mask: bools, t: step along rays)
 #
 # note that this implementation is efficient in that it only will compute distance
-# for pts that are still candidates.
+# for pts that are still candidates. Those are kept as a compacted list of ray indices which
+# shrinks as rays hit or escape, and results are only scattered back once at the end.
 def sphere_march(
   self,
   r_o, r_d,
   iters: int = 32,
   eps: float = 1e-3,
   near: float = 0, far: float = 1,
+  chunk_size: int = 1 << 18,
 ):
   device = r_o.device
+  shape = r_o.shape[:-1]
   with torch.no_grad():
-    hits = torch.zeros(r_o.shape[:-1] + (1,), dtype=torch.bool, device=device)
-    rem = torch.ones_like(hits).squeeze(-1)
-    curr_dist = torch.full_like(hits, near, dtype=torch.float)
+    r_o, r_d = r_o.reshape(-1, 3), r_d.reshape(-1, 3)
+    N = r_o.shape[0]
+    alive = torch.arange(N, device=device)
+    curr_dist = torch.full((N,), near, device=device, dtype=r_o.dtype)
+    done_idxs, done_dists, done_hits = [], [], []
+    counts = []
     for i in range(iters):
-      curr = r_o[rem] + r_d[rem] * curr_dist[rem]
-      dist = self(curr)[...,0].reshape_as(curr_dist[rem])
-      hits[rem] |= ((dist < eps) & (curr_dist[rem] <= far))
+      if alive.numel() == 0: break
+      counts.append(alive.numel())
+      dist = chunked_sdf(self, r_o[alive] + r_d[alive] * curr_dist[:, None], chunk_size)
+      hit = (dist < eps) & (curr_dist <= far)
+      curr_dist = curr_dist + dist
       # anything that was hit or is past range no longer need to compute
-      curr_dist[rem] += dist
-      rem[hits.squeeze(-1) | (curr_dist > far).squeeze(-1)] = False
-    curr = r_o + r_d * curr_dist
-  return curr, hits.squeeze(-1), curr_dist, None
+      done = hit | (curr_dist > far)
+      done_idxs.append(alive[done])
+      done_dists.append(curr_dist[done])
+      done_hits.append(hit[done])
+      alive, curr_dist = alive[~done], curr_dist[~done]
+    stats.record(counts)
+
+    dists = torch.full((N,), near, device=device, dtype=r_o.dtype)
+    hits = torch.zeros(N, dtype=torch.bool, device=device)
+    idxs = torch.cat(done_idxs + [alive])
+    dists[idxs] = torch.cat(done_dists + [curr_dist])
+    hits[idxs] = torch.cat(done_hits + [torch.zeros_like(alive, dtype=torch.bool)])
+    dists = dists.reshape(shape + (1,))
+    curr = r_o.reshape(shape + (3,)) + r_d.reshape(shape + (3,)) * dists
+  return curr, hits.reshape(shape), dists, None
+
+# Sphere marches for a few steps, which brings most rays close to the surface or past far.
+# Rays which step into the surface are bracketed between their last two steps, and rays which
+# are still marching are densely scanned up to far for a sign change. Only bracketed rays are
+# then refined with bisection, or secant steps if secant is true.
+def hybrid(
+  self,
+  r_o, r_d,
+  iters: int = 128,
+  eps: float = 1e-3,
+  near: float = 0, far: float = 1,
+  sphere_iters: int = 16,
+  refine_iters: int = 16,
+  secant: bool = False,
+  chunk_size: int = 1 << 18,
+):
+  device = r_o.device
+  shape = r_o.shape[:-1]
+  # iters is the budget of the dense methods, of which a quarter is used for the scan.
+  scan_steps = max(iters // 4, 1)
+  with torch.no_grad():
+    o, d = r_o.reshape(-1, 3), r_d.reshape(-1, 3)
+    N = o.shape[0]
+    t = torch.full((N,), near, device=device, dtype=o.dtype)
+    # the start of the bracket around the surface for each ray, where t is its end.
+    low = torch.full_like(t, -1)
+    hits = torch.zeros(N, dtype=torch.bool, device=device)
+    # the sample with the lowest SDF for each ray, used for throughput.
+    best_t = t.clone()
+    best_sd = torch.full_like(t, float("inf"))
+
+    alive = torch.arange(N, device=device)
+    curr, prev = t.clone(), t.clone()
+    for i in range(sphere_iters):
+      if alive.numel() == 0: break
+      sd = chunked_sdf(self, o[alive] + d[alive] * curr[:, None], chunk_size)
+      better = sd < best_sd[alive]
+      best_sd[alive[better]] = sd[better]
+      best_t[alive[better]] = curr[better]
+
+      converged = (sd >= 0) & (sd < eps) & (curr <= far)
+      crossed = (sd < 0) & (curr <= far)
+      hits[alive[converged]] = True
+      t[alive[converged | crossed]] = curr[converged | crossed]
+      low[alive[crossed]] = prev[crossed]
+      prev, curr = curr, curr + sd.clamp(min=0)
+      keep = ~(converged | crossed) & (curr <= far)
+      alive, curr, prev = alive[keep], curr[keep], prev[keep]
+
+    if alive.numel() > 0:
+      A = alive.shape[0]
+      steps = torch.linspace(0, 1, scan_steps + 1, device=device, dtype=o.dtype)[1:]
+      ts = curr[:, None] + (far - curr[:, None]).clamp(min=0) * steps
+      pts = o[alive, None] + d[alive, None] * ts[..., None]
+      sds = chunked_sdf(self, pts.reshape(-1, 3), chunk_size).reshape(A, scan_steps)
+      min_sd, min_idx = sds.min(dim=-1)
+      better = min_sd < best_sd[alive]
+      best_sd[alive[better]] = min_sd[better]
+      best_t[alive[better]] = ts.gather(-1, min_idx[:, None])[better, 0]
+
+      neg = sds < 0
+      crossed = neg.any(dim=-1)
+      first = neg.float().argmax(dim=-1, keepdim=True)
+      prev_ts = torch.cat([curr[:, None], ts[:, :-1]], dim=-1)
+      low[alive[crossed]] = prev_ts.gather(-1, first)[crossed, 0]
+      t[alive[crossed]] = ts.gather(-1, first)[crossed, 0]
+
+    idxs = (low >= 0).nonzero().squeeze(-1)
+    if idxs.numel() > 0:
+      lo, hi = low[idxs], t[idxs]
+      ro, rd = o[idxs], d[idxs]
+      sdf_at = lambda z: chunked_sdf(self, ro + rd * z[:, None], chunk_size)
+      sd_lo, sd_hi = sdf_at(lo), sdf_at(hi)
+      for i in range(refine_iters):
+        mid = (lo + hi)/2
+        if secant:
+          denom = sd_lo - sd_hi
+          valid = denom.abs() >= 1e-8
+          sec = lo + sd_lo * (hi - lo)/torch.where(valid, denom, torch.ones_like(denom))
+          # only take secant steps which stay inside of the bracket.
+          mid = torch.where(valid & (sec > lo) & (sec < hi), sec, mid)
+        sd_mid = sdf_at(mid)
+        pos = sd_mid > 0
+        lo, sd_lo = torch.where(pos, mid, lo), torch.where(pos, sd_mid, sd_lo)
+        hi, sd_hi = torch.where(pos, hi, mid), torch.where(pos, sd_hi, sd_mid)
+      if secant: t[idxs] = torch.where(sd_lo.abs() < sd_hi.abs(), lo, hi)
+      else: t[idxs] = (lo + hi)/2
+      hits[idxs] = True
+
+    best_t = torch.where(hits, t, best_t).reshape(shape + (1,))
+    t = t.reshape(shape + (1,))
+  best_pos = r_o + best_t * r_d
+  tput = self(best_pos)[..., 0]
+  return r_o + t * r_d, hits.reshape(shape), t, tput.unsqueeze(-1)
 
 # finds an intersection with secant intersection
 def secant(
@@ -51,8 +190,11 @@ def secant(
   iters: int = 128,
   eps: float = 1e-3,
   near: float = 0, far: float = 1,
+  chunk_size: int = 1 << 18,
 ):
-  tput, best_pos, last_pos, first_neg = throughput_with_sign_change(self, r_o, r_d, near, far, batch_size=iters)
+  tput, best_pos, last_pos, first_neg = throughput_with_sign_change(
+    self, r_o, r_d, near, far, batch_size=iters, chunk_size=chunk_size,
+  )
   pts = secant_find(self, r_o, r_d, near=last_pos, far = first_neg, iters=iters)
   hits = tput < 0
   return pts, hits, best_pos, tput
@@ -64,14 +206,24 @@ def bisect(
   iters: int = 128,
   eps: float = 0,
   near: float = 0, far: float = 1,
+  chunk_size: int = 1 << 18,
 ):
   tput, best_pos, last_pos, first_neg = throughput_with_sign_change(
-    self, r_o, r_d, near=near, far=far, batch_size=iters,
+    self, r_o, r_d, near=near, far=far, batch_size=iters, chunk_size=chunk_size,
   )
   pts = bisection(self, r_o, r_d, near=last_pos, far = first_neg, iters=min(32, iters))
   hits = tput < 0
   return pts, hits, best_pos, tput.unsqueeze(-1)
 
+# evaluates the SDF at distances ts [S] along every ray, with as many steps in each call as fit
+# in chunk_size points. Yields the index of the first step and the SDF [K, ...] of K steps.
+def scan(self, r_o, r_d, ts, chunk_size: int):
+  rays = max(r_o.numel() // 3, 1)
+  K = max(1, chunk_size // rays)
+  for start in range(0, ts.shape[0], K):
+    t = ts[start:start+K].reshape((-1,) + (1,) * len(r_o.shape))
+    yield start, self(r_o.unsqueeze(0) + t * r_d.unsqueeze(0))[..., 0]
+
 # computes throughput as well positions where the signs change
 def throughput_with_sign_change(
   self,
@@ -79,25 +231,29 @@ def throughput_with_sign_change(
   near: float,
   far: float,
   batch_size:int = 128,
+  chunk_size: int = 1 << 18,
 ):
   # some random jitter I guess?
   max_t = far-near+random.random()*(2/batch_size)
   step = max_t/batch_size
   with torch.no_grad():
-    sd = self(r_o + near)[...,0]
+    sd = self(r_o + near * r_d)[...,0]
     curr_min = sd
     idxs = torch.zeros_like(sd, dtype=torch.long)
     # pos and neg indeces
     last_pos = torch.full_like(sd, -1, dtype=torch.long)
     first_neg = torch.full_like(sd, -1, dtype=torch.long)
-    for i in range(batch_size):
-      t = near + step * (i+1)
-      sd = self(r_o + t * r_d)[..., 0]
-      idxs = torch.where(sd < curr_min, i+1, idxs)
-      curr_min = torch.minimum(curr_min, sd)
-      mask = (first_neg == -1) & (sd < 0)
-      last_pos = torch.where(mask, i, last_pos)
-      first_neg = torch.where(mask, i + 1, first_neg)
+    ts = near + step * torch.arange(1, batch_size+1, device=r_o.device, dtype=r_o.dtype)
+    for start, sds in scan(self, r_o, r_d, ts, chunk_size):
+      # min is strict so that ties keep the earliest step, as when stepping one at a time.
+      chunk_min, chunk_idxs = sds.min(dim=0)
+      idxs = torch.where(chunk_min < curr_min, start + chunk_idxs + 1, idxs)
+      curr_min = torch.minimum(curr_min, chunk_min)
+      neg = sds < 0
+      first = start + neg.float().argmax(dim=0)
+      mask = (first_neg == -1) & neg.any(dim=0)
+      last_pos = torch.where(mask, first, last_pos)
+      first_neg = torch.where(mask, first + 1, first_neg)
     idxs = idxs.unsqueeze(-1)
     # convert from indeces to t
     best_pos = r_o  + (near + idxs * step) * r_d
@@ -181,6 +337,7 @@ def throughput(
   r_o, r_d,
   near: float, far: float,
   batch_size:int = 128,
+  chunk_size: int = 1 << 18,
 ):
   assert(far > near)
   # some random jitter I guess?
@@ -190,11 +347,11 @@ def throughput(
     sd = self(r_o + near * r_d)[...,0]
     curr_min = sd
     idxs = torch.zeros_like(sd, dtype=torch.long, device=r_d.device)
-    for i in range(batch_size):
-      t = near + step * (i+1)
-      sd = self(r_o + t * r_d)[..., 0]
-      idxs = torch.where(sd < curr_min, i+1, idxs)
-      curr_min = torch.minimum(curr_min, sd)
+    ts = near + step * torch.arange(1, batch_size+1, device=r_o.device, dtype=r_o.dtype)
+    for start, sds in scan(self, r_o, r_d, ts, chunk_size):
+      chunk_min, chunk_idxs = sds.min(dim=0)
+      idxs = torch.where(chunk_min < curr_min, start + chunk_idxs + 1, idxs)
+      curr_min = torch.minimum(curr_min, chunk_min)
     idxs = idxs.unsqueeze(-1)
     best_pos = r_o  + (near + idxs * step) * r_d
   return self(best_pos)[...,0], best_pos
@@ -4,14 +4,18 @@ import torch.nn.functional as F
 import random
 
 from .neural_blocks import (
-  SkipConnMLP, UpdateOperator, FourierEncoder, PositionalEncoder, NNEncoder
+  SkipConnMLP, UpdateOperator, FourierEncoder, PositionalEncoder, NNEncoder,
+  feature_grid_encoders,
 )
 from .utils import (
-  dir_to_elev_azim, autograd, sample_random_hemisphere, laplace_cdf, load_sigmoid,
+  dir_to_elev_azim, autograd, sample_random_hemisphere, laplace_cdf, load_sigmoid, fp32,
+  checkpoint_chunks, ray_aabb, ray_sphere,
 )
 import src.refl as refl
 from .renderers import ( load_occlusion_kind, direct )
 import src.march as march
+import src.packed as packed
+from .spherical_harmonics import eval_sh
 
 @torch.jit.script
 def cumuprod_exclusive(t):
@@ -21,13 +25,19 @@ def cumuprod_exclusive(t):
   return cp
 
 #@torch.jit.script # cannot jit script cause of tensordot :)
+# near and far are either shared by all rays, or per ray [B, H, W] in which case ts are per ray
+# [T, B, H, W].
 def compute_pts_ts(
   rays, near, far, steps, lindisp=False,
   perturb: float = 0,
 ):
   r_o, r_d = rays.split([3,3], dim=-1)
   device = r_o.device
-  if lindisp:
+  if torch.is_tensor(near):
+    t_vals = torch.linspace(0, 1, steps, device=device, dtype=r_o.dtype)[:, None, None, None]
+    if lindisp: ts = 1/(1/near.clamp(min=1e-10) * (1-t_vals) + 1/far * t_vals)
+    else: ts = near + (far - near) * t_vals
+  elif lindisp:
     t_vals = torch.linspace(0, 1, steps, device=device, dtype=r_o.dtype)
     ts = 1/(1/max(near, 1e-10) * (1-t_vals) + 1/far * (t_vals))
   else:
@@ -39,12 +49,76 @@ def compute_pts_ts(
     upper = torch.cat([ts[:1], mids])
     rand = torch.rand_like(lower) * perturb
     ts = lower + (upper - lower) * rand
-  pts = r_o.unsqueeze(0) + torch.tensordot(ts, r_d, dims = 0)
+  if len(ts.shape) == 1: pts = r_o.unsqueeze(0) + torch.tensordot(ts, r_d, dims = 0)
+  else: pts = r_o.unsqueeze(0) + ts[..., None] * r_d.unsqueeze(0)
   return pts, ts, r_o, r_d
 
+# Samples `n` new ts per ray from the piecewise constant pdf defined by weights at ts.
+# ts may either be shared by all rays [T] or be per ray [T, B, H, W], weights are [T, B, H, W].
+# Returns [n, B, H, W] ts, which are not sorted with respect to the original ts.
+def sample_pdf(ts, weights, n: int, perturb: bool = False):
+  if len(ts.shape) == 1: ts = ts[:, None, None, None].expand_as(weights)
+  # searchsorted operates on the innermost dimension, so move samples there.
+  ts = ts.movedim(0, -1)
+  weights = weights.movedim(0, -1)
+
+  mids = 0.5 * (ts[..., 1:] + ts[..., :-1])
+  # the first and last weights are dropped since they have no bin on one side.
+  weights = weights[..., 1:-1] + 1e-5
+  pdf = weights/weights.sum(dim=-1, keepdim=True)
+  cdf = torch.cumsum(pdf, dim=-1)
+  cdf = torch.cat([torch.zeros_like(cdf[..., :1]), cdf], dim=-1)
+
+  u_shape = cdf.shape[:-1] + (n,)
+  if perturb: u = torch.rand(u_shape, device=cdf.device, dtype=cdf.dtype)
+  else: u = torch.linspace(0, 1, n, device=cdf.device, dtype=cdf.dtype).expand(u_shape)
+  u = u.contiguous()
+
+  inds = torch.searchsorted(cdf.contiguous(), u, right=True)
+  below = (inds - 1).clamp(min=0)
+  above = inds.clamp(max=cdf.shape[-1]-1)
+
+  cdf_below = torch.gather(cdf, -1, below)
+  cdf_above = torch.gather(cdf, -1, above)
+  bins_below = torch.gather(mids, -1, below)
+  bins_above = torch.gather(mids, -1, above)
+
+  denom = cdf_above - cdf_below
+  denom = torch.where(denom < 1e-5, torch.ones_like(denom), denom)
+  t = (u - cdf_below)/denom
+  samples = bins_below + t * (bins_above - bins_below)
+  return samples.movedim(-1, 0)
+
+# Combines coarse ts with fine ts sampled along each ray, returning sorted per ray ts and pts, and
+# where each merged sample is in the coarse samples followed by the fine samples.
+def merge_ts(ts, fine_ts, r_o, r_d):
+  if len(ts.shape) == 1: ts = ts[:, None, None, None].expand((-1,) + fine_ts.shape[1:])
+  ts, order = torch.sort(torch.cat([ts, fine_ts], dim=0), dim=0)
+  pts = r_o.unsqueeze(0) + ts.unsqueeze(-1) * r_d.unsqueeze(0)
+  return pts, ts, order
+
+# reorders per sample values [T, B, H, W, ...] along T by order [T, B, H, W].
+def take_ts(vals, order):
+  order = order.reshape(order.shape + (1,) * (len(vals.shape) - len(order.shape)))
+  return torch.gather(vals, 0, order.expand_as(vals))
+
+# evaluates fn only on samples where mask is true, and scatters the output into a zero filled
+# tensor of the full shape. Tensor arguments must have the same leading dims as mask.
+def sparse_eval(mask, fn, *args, **kwargs):
+  if mask is None: return fn(*args, **kwargs)
+  sub = lambda v: v[mask] if isinstance(v, torch.Tensor) else v
+  out = fn(*[sub(a) for a in args], **{ k: sub(v) for k, v in kwargs.items() })
+  full = torch.zeros(mask.shape + out.shape[1:], device=out.device, dtype=out.dtype)
+  full[mask] = out
+  return full
+
+# expands ts so it can be volumetrically integrated, regardless if it is shared or per ray.
+def expand_ts(ts): return ts[:, None, None, None, None] if len(ts.shape) == 1 else ts[..., None]
+
 # given a set of densities, and distances between the densities,
 # compute alphas from them.
 #@torch.jit.script
+@fp32
 def alpha_from_density(
   density, ts, r_d,
   softplus: bool = True,
@@ -54,14 +128,18 @@ def alpha_from_density(
   if softplus: sigma_a = F.softplus(density-1)
   else: sigma_a = F.relu(density)
 
-  end_val = torch.full_like(ts[..., :1], 1e10)
-  dists = torch.cat([ts[..., 1:] - ts[..., :-1], end_val], dim=-1)
-  while len(dists.shape) < 4: dists = dists[..., None]
-  dists = dists * torch.linalg.norm(r_d, dim=-1)
-  alpha = 1 - torch.exp(-sigma_a * dists)
+  alpha = 1 - torch.exp(-sigma_a * sample_dists(ts, r_d))
   weights = alpha * cumuprod_exclusive(1.0 - alpha + 1e-10)
   return alpha, weights
 
+# distance between each sample and the next along each ray, [T, B, H, W].
+def sample_dists(ts, r_d):
+  # ts are either shared [T] or per ray [T, B, H, W], but in both cases samples are on dim 0.
+  end_val = torch.full_like(ts[:1], 1e10)
+  dists = torch.cat([ts[1:] - ts[:-1], end_val], dim=0)
+  while len(dists.shape) < 4: dists = dists[..., None]
+  return dists * torch.linalg.norm(r_d, dim=-1)
+
 # TODO delete these for utils
 
 # sigmoids which shrink or expand the total range to prevent gradient vanishing,
@@ -81,8 +159,7 @@ def volumetric_integrate(weights, other):
 # perform volumetric integration but only using some of other's values where the weights
 # are big enough.
 #
-# TODO the computation of `other` itself should be sparse, so that it doesn't need to be
-# computed in the first place.
+# To avoid computing `other` in the first place, see CommonNeRF.set_shade_eps.
 @torch.jit.script
 def sparse_volumetric_integrate(weights, other, eps:float=1e-3):
   vals = torch.full_like(other, 1e-3)
@@ -90,6 +167,53 @@ def sparse_volumetric_integrate(weights, other, eps:float=1e-3):
   vals[mask] = other[mask]
   return torch.sum(weights[..., None] * vals, dim=0)
 
+# Fused alpha_from_density and volumetric_integrate of color, depth and accumulation.
+# Only the inputs are kept for backward, and alpha, transmittance and weights are recomputed
+# there, rather than autograd keeping every intermediate of the composite alive.
+class FusedComposite(torch.autograd.Function):
+  @staticmethod
+  def transmittance(density, dists, softplus: bool):
+    sigma_a = F.softplus(density-1) if softplus else F.relu(density)
+    s = sigma_a * dists
+    # exclusive scan of optical depth, the last dist of 1e10 is never summed into it.
+    depth = torch.cat([torch.zeros_like(s[:1]), torch.cumsum(s[:-1], dim=0)], dim=0)
+    return s, torch.exp(-depth)
+  @staticmethod
+  def forward(ctx, density, dists, ts, rgb, softplus: bool):
+    s, trans = FusedComposite.transmittance(density, dists, softplus)
+    alpha = -torch.expm1(-s)
+    weights = alpha * trans
+    color = torch.einsum("t...,t...c->...c", weights, rgb)
+    depth = (weights * ts).sum(dim=0)
+    acc = weights.sum(dim=0)
+    ctx.save_for_backward(density, dists, ts, rgb)
+    ctx.softplus = softplus
+    return color, depth, acc, alpha, weights
+  @staticmethod
+  def backward(ctx, g_color, g_depth, g_acc, g_alpha, g_weights):
+    density, dists, ts, rgb = ctx.saved_tensors
+    s, trans = FusedComposite.transmittance(density, dists, ctx.softplus)
+    keep = torch.exp(-s)
+    weights = (1 - keep) * trans
+    # gradient of the loss w.r.t. each weight, from every output which depends on it.
+    v = torch.einsum("...c,t...c->t...", g_color, rgb) + g_depth * ts + g_acc + g_weights
+    vw = v * weights
+    # weights after a sample are scaled by its transmittance: d w_k/d s_i = -w_k for k > i.
+    after = torch.flip(torch.cumsum(torch.flip(vw, (0,)), dim=0), (0,)) - vw
+    g_s = (v * trans + g_alpha) * keep - after
+    if ctx.softplus: d_sigma = torch.sigmoid(density-1)
+    else: d_sigma = (density > 0).to(density.dtype)
+    g_density = g_s * dists * d_sigma
+    g_rgb = weights[..., None] * g_color
+    return g_density, None, None, g_rgb, None
+
+# returns (color, depth, acc, alpha, weights) for densities and colors [T, B, H, W, C] at ts.
+@fp32
+def fused_composite(density, ts, r_d, rgb, softplus: bool = True):
+  dists = sample_dists(ts, r_d).expand_as(density)
+  ts = expand_ts(ts)[..., 0].expand_as(density)
+  return FusedComposite.apply(density, dists, ts, rgb, softplus)
+
 
 # bg functions, need to be here for pickling
 def black(_elaz_r_d, _weights): return 0
@@ -106,6 +230,8 @@ class CommonNeRF(nn.Module):
     self,
 
     steps: int = 64,
+    # if > 0, steps are used for a coarse pass, and this many more are importance sampled.
+    fine_steps: int = 0,
 
     #out_features: int = 3, # 3 is for RGB
     t_near: float = 0,
@@ -130,7 +256,9 @@ class CommonNeRF(nn.Module):
     self.t_near = t_near
     self.t_far = t_far
     self.steps = steps
+    self.fine_steps = fine_steps
     self.mip = mip
+    assert(fine_steps == 0 or mip is None), "Hierarchical sampling does not support mip yet"
 
     self.per_pixel_latent_size = per_pixel_latent_size
     self.per_pixel_latent = None
@@ -152,6 +280,258 @@ class CommonNeRF(nn.Module):
     self.depth = None
 
   def forward(self, _x): raise NotImplementedError()
+  # returns which samples lie in occupied space, or None if there is no occupancy grid.
+  def occupied(self, pts):
+    grid = getattr(self, "occupancy", None)
+    return None if grid is None else grid(pts)
+  # sets density of samples in empty space such that they have no alpha.
+  def skip_empty(self, mask, density):
+    if mask is None: return density
+    while len(mask.shape) < len(density.shape): mask = mask[..., None]
+    return torch.where(mask, density, torch.full_like(density, -1e10))
+  # refreshes the occupancy grid from the current density, should be called periodically.
+  def update_occupancy(self):
+    grid = getattr(self, "occupancy", None)
+    if grid is None: return
+    assert(self.mip is None), "Occupancy grid does not support mip"
+    step_size = (self.t_far - self.t_near)/(self.steps + getattr(self, "fine_steps", 0))
+    grid.update(
+      lambda pts: self.compute_density(pts, None, None, None),
+      step_size=step_size, softplus=self.softplus_density,
+    )
+  # computes only the density at each point, without any reflectance.
+  def compute_density(self, pts, ts, r_o, r_d): raise NotImplementedError()
+  # whether the raw density should have softplus applied to it when computing alpha
+  softplus_density = True
+  # computes (density, rgb) for every sample, samples outside of mask are considered empty.
+  def shade(self, pts, ts, r_o, r_d, mask=None):
+    density, feats = self.shade_density(pts, ts, r_o, r_d, mask=mask)
+    return density, self.shade_color(feats, pts, ts, r_o, r_d, mask=mask)
+  # computes (density, feats) for every sample, where feats are whatever shade_color needs.
+  def shade_density(self, pts, ts, r_o, r_d, mask=None): raise NotImplementedError()
+  # computes rgb for every sample in mask from the features of shade_density.
+  def shade_color(self, feats, pts, ts, r_o, r_d, mask=None): raise NotImplementedError()
+  # per sample attributes set by shade which should be concatenated when marching in chunks.
+  per_sample_attrs = ()
+  # color of whatever is not covered by the volume
+  def background(self, r_d, weights): return self.sky_color(None, weights)
+
+  def from_pts(self, pts, ts, r_o, r_d):
+    if self.should_march(): return self.march(pts, ts, r_o, r_d)
+    if self.should_pack():
+      samples = packed.pack(
+        pts, ts, sample_dists(ts, r_d), r_o, r_d, keep=self.sample_mask(pts),
+      )
+      out = self.from_packed(samples)
+      return out.reshape(pts.shape[1:-1] + out.shape[-1:])
+    mask = self.sample_mask(pts)
+    shade_eps = getattr(self, "shade_eps", 0)
+    coarse, self.coarse = getattr(self, "coarse", None), None
+    if shade_eps <= 0 and coarse is None: density, rgb = self.shade(pts, ts, r_o, r_d, mask=mask)
+    elif shade_eps <= 0:
+      density, feats = self.merged_density(coarse, r_o, r_d)
+      rgb = self.shade_color(feats, pts, ts, r_o, r_d, mask=mask)
+    else:
+      # density is computed for all samples first, then color only where it will be visible.
+      if coarse is None: density, feats = self.shade_density(pts, ts, r_o, r_d, mask=mask)
+      else: density, feats = self.merged_density(coarse, r_o, r_d)
+      with torch.no_grad():
+        _, weights = alpha_from_density(density, ts, r_d, softplus=self.softplus_density)
+      rgb = self.shade_color(feats, pts, ts, r_o, r_d, mask=weights > shade_eps)
+    if getattr(self, "use_fused", False):
+      rgb, self.depth, acc, self.alpha, self.weights = fused_composite(
+        density, ts, r_d, rgb, softplus=self.softplus_density,
+      )
+      return rgb + self.background(r_d, acc[None])
+    self.alpha, self.weights = alpha_from_density(density, ts, r_d, softplus=self.softplus_density)
+    return volumetric_integrate(self.weights, rgb) + self.background(r_d, self.weights)
+
+  # march_chunk > 0 evaluates samples in chunks of that size, retiring rays whose transmittance
+  # drops below min_transmittance. By default it is only used for inference.
+  def set_march(
+    self, march_chunk: int = 0, min_transmittance: float = 1e-3, in_training: bool = False,
+  ):
+    self.march_chunk = march_chunk
+    self.min_transmittance = min_transmittance
+    self.march_in_training = in_training
+  def should_march(self) -> bool:
+    if getattr(self, "march_chunk", 0) <= 0 or self.mip is not None: return False
+    # per point latents cover every sample along each ray, not just one chunk of them.
+    if self.per_pt_latent_size > 0: return False
+    return not self.training or self.march_in_training
+
+  # clips rays to an axis aligned box (lo, hi) and/or a sphere at the origin with radius > 0, so
+  # that all samples of a ray lie inside the scene and rays missing it are never shaded.
+  def set_bounds(self, box=None, sphere: float = -1):
+    assert(box is None or len(box) == 6), "Bounding box must be (x0, y0, z0, x1, y1, z1)"
+    assert((box is None and sphere <= 0) or self.mip is None), "Bounds do not support mip"
+    self.bound_box = None if box is None else (tuple(box[:3]), tuple(box[3:]))
+    self.bound_sphere = sphere
+  # returns near [B, H, W], far [B, H, W] and whether each ray hits the bounds, or the global
+  # near and far if there are no bounds.
+  def ray_bounds(self, r_o, r_d):
+    box = getattr(self, "bound_box", None)
+    sphere = getattr(self, "bound_sphere", -1)
+    if box is None and sphere <= 0: return self.t_near, self.t_far, None
+    near = torch.full_like(r_o[..., 0], self.t_near)
+    far = torch.full_like(r_o[..., 0], self.t_far)
+    if box is not None:
+      lo, hi = [torch.tensor(v, device=r_o.device, dtype=r_o.dtype) for v in box]
+      t0, t1 = ray_aabb(r_o, r_d, lo, hi)
+      near, far = torch.maximum(near, t0), torch.minimum(far, t1)
+    if sphere > 0:
+      t0, t1 = ray_sphere(r_o, r_d, sphere)
+      near, far = torch.maximum(near, t0), torch.minimum(far, t1)
+    hit = far > near
+    # rays which miss put all their samples at the same distance, and are masked out.
+    near = torch.where(hit, near, torch.full_like(near, self.t_near))
+    return near, torch.where(hit, far, near), hit
+  # computes uniformly spaced samples along each ray between its near and far bounds.
+  def ray_samples(self, rays, perturb: float = 0):
+    r_o, r_d = rays.split([3,3], dim=-1)
+    near, far, self.ray_hit = self.ray_bounds(r_o, r_d)
+    return compute_pts_ts(rays, near, far, self.steps, perturb=perturb)
+  # which samples should be shaded, those in occupied space on rays which hit the bounds, or None
+  # if all of them should.
+  def sample_mask(self, pts):
+    mask = self.occupied(pts)
+    hit = getattr(self, "ray_hit", None)
+    if hit is None or hit.shape != pts.shape[1:-1]: return mask
+    hit = hit.unsqueeze(0).expand(pts.shape[:-1])
+    return hit if mask is None else mask & hit
+
+  # shade_eps > 0 only computes color for samples whose weight is above it.
+  def set_shade_eps(self, eps: float = 0): self.shade_eps = eps
+  # modules making up each part of the model which can be checkpointed.
+  def checkpoint_parts(self):
+    refl_part = getattr(self, "refl", None)
+    return {
+      "density": [m for name, m in self.named_children() if name != "refl"],
+      "refl": [refl_part] if isinstance(refl_part, nn.Module) else [],
+    }
+  # checkpoints every MLP in the given parts of the model, recomputing their activations in
+  # backward for chunks of chunk_size samples at a time.
+  def set_checkpoint(self, parts=[], chunk_size: int = 1 << 14):
+    known = self.checkpoint_parts()
+    for part in parts: assert(part in known), f"Cannot checkpoint {part} of {type(self)}"
+    for part, modules in known.items():
+      for module in modules:
+        for m in module.modules():
+          if isinstance(m, SkipConnMLP): m.checkpoint_chunk = chunk_size if part in parts else 0
+
+  # computes compositing with a single fused op, which recomputes intermediates in backward.
+  def set_fused_composite(self, fused: bool = True): self.use_fused = fused
+
+  # packing stores only the samples which are kept by the occupancy grid in one flat buffer,
+  # rather than a dense [T, B, H, W] layout.
+  def set_packed(self, use_packed: bool = True): self.use_packed = use_packed
+  # whether shade can be evaluated on samples which are not grouped by image. Latents are laid
+  # out per image, pixel or dense sample, so they cannot follow samples into a packed buffer.
+  @property
+  def can_pack(self) -> bool: return self.mip is None and self.total_latent_size() == 0
+  def should_pack(self) -> bool: return getattr(self, "use_packed", False) and self.can_pack
+
+  # volume renders packed samples, returning [R, C] for each ray. If the samples were packed
+  # from a dense layout, per sample values such as weights are unpacked back into it.
+  def from_packed(self, samples: packed.PackedSamples):
+    # shade expects samples on dim 0, so the flat buffer is treated as one sample of N rays.
+    density, rgb = self.shade(
+      samples.pts[None], samples.ts[None],
+      samples.per_sample(samples.r_o), samples.per_sample(samples.r_d),
+    )
+    density, rgb = density[0], rgb[0]
+    alpha, weights = packed.alpha_from_density(
+      density, samples, softplus=self.softplus_density,
+    )
+    if samples.dense_shape is None: self.alpha, self.weights = alpha, weights
+    else:
+      self.alpha, self.weights = samples.unpack(alpha), samples.unpack(weights)
+      for attr in self.per_sample_attrs:
+        val = getattr(self, attr, None)
+        if val is not None: setattr(self, attr, samples.unpack(val[0]))
+    acc = packed.segment_sum(weights, samples)
+    return packed.volumetric_integrate(weights, rgb, samples) + \
+      self.background(samples.r_d, acc[None])
+
+  # volume renders by marching front to back in chunks of samples, so that samples behind
+  # opaque surfaces are never shaded. Equivalent to from_pts up to min_transmittance.
+  def march(self, pts, ts, r_o, r_d):
+    T = pts.shape[0]
+    dists = sample_dists(ts, r_d)
+    occupied = self.sample_mask(pts)
+    trans = torch.ones(pts.shape[1:-1], device=pts.device, dtype=pts.dtype)
+    alphas, weights, rgbs = [], [], []
+    attrs = { attr: [] for attr in self.per_sample_attrs }
+    for start in range(0, T, self.march_chunk):
+      end = min(start + self.march_chunk, T)
+      alive = trans > self.min_transmittance
+      if not alive.any(): break
+      mask = alive.unsqueeze(0).expand((end - start,) + alive.shape)
+      if occupied is not None: mask = mask & occupied[start:end]
+      density, rgb = self.shade(
+        pts[start:end], ts[start:end], r_o, r_d, mask=mask,
+      )
+      # transmittance is kept in fp32 under mixed precision.
+      density = density.float()
+      if self.softplus_density: sigma_a = F.softplus(density-1)
+      else: sigma_a = F.relu(density)
+      alpha = 1 - torch.exp(-sigma_a * dists[start:end])
+      weights.append(trans.unsqueeze(0) * alpha * cumuprod_exclusive(1.0 - alpha + 1e-10))
+      trans = trans * torch.prod(1.0 - alpha + 1e-10, dim=0)
+      alphas.append(alpha)
+      rgbs.append(rgb)
+      for attr, vals in attrs.items(): vals.append(getattr(self, attr))
+    # rays which were all retired contribute nothing from the remaining samples.
+    done = sum(a.shape[0] for a in alphas)
+    if done < T:
+      rest = (T - done,) + trans.shape
+      alphas.append(torch.zeros(rest, device=pts.device, dtype=pts.dtype))
+      weights.append(torch.zeros(rest, device=pts.device, dtype=pts.dtype))
+      rgbs.append(rgbs[-1].new_zeros(rest + rgbs[-1].shape[-1:]))
+      for attr, vals in attrs.items():
+        if vals[-1] is not None: vals.append(vals[-1].new_zeros(rest + vals[-1].shape[-1:]))
+    for attr, vals in attrs.items():
+      setattr(self, attr, None if vals[0] is None else torch.cat(vals, dim=0))
+    self.alpha = torch.cat(alphas, dim=0)
+    self.weights = torch.cat(weights, dim=0)
+    rgb = torch.cat(rgbs, dim=0)
+    return volumetric_integrate(self.weights, rgb) + self.background(r_d, self.weights)
+
+  # computes points along each ray. With fine_steps > 0 the coarse samples are shaded first to
+  # build a pdf along each ray, and fine samples are placed where the weights are. The coarse
+  # density is kept for from_pts, so only the fine samples are shaded after merging.
+  def sample_pts(self, rays):
+    pts, ts, r_o, r_d = self.ray_samples(rays, perturb = 1 if self.training else 0)
+    self.coarse = None
+    fine_steps = getattr(self, "fine_steps", 0)
+    if fine_steps <= 0: return pts, ts, r_o, r_d
+    # marching and packing shade samples in their own order, so they only get the merged samples
+    # and the coarse pass just computes density without gradients.
+    reuse = not self.should_march() and not self.should_pack()
+    mask = self.sample_mask(pts)
+    if reuse: density, feats = self.shade_density(pts, ts, r_o, r_d, mask=mask)
+    else:
+      with torch.no_grad():
+        density = sparse_eval(mask, lambda p: self.compute_density(p, ts, r_o, r_d), pts)
+        density = self.skip_empty(mask, density)
+    with torch.no_grad():
+      _, weights = alpha_from_density(density, ts, r_d, softplus=self.softplus_density)
+      fine_ts = sample_pdf(ts, weights, fine_steps, perturb=self.training)
+      pts, merged_ts, order = merge_ts(ts, fine_ts, r_o, r_d)
+    if reuse:
+      fine_pts = r_o.unsqueeze(0) + fine_ts.unsqueeze(-1) * r_d.unsqueeze(0)
+      self.coarse = (density, feats, fine_pts, fine_ts, order)
+    return pts, merged_ts, r_o, r_d
+  # density and features of the merged samples of sample_pts, only shading the fine samples.
+  def merged_density(self, coarse, r_o, r_d):
+    density, feats, fine_pts, fine_ts, order = coarse
+    fine_density, fine_feats = self.shade_density(
+      fine_pts, fine_ts, r_o, r_d, mask=self.sample_mask(fine_pts),
+    )
+    density = take_ts(torch.cat([density, fine_density], dim=0), order)
+    if feats is not None: feats = take_ts(torch.cat([feats, fine_feats], dim=0), order)
+    return density, feats
+
   def set_bg(self, bg="black"):
     if bg == "black":
       self.sky_color = black
@@ -215,7 +595,7 @@ class CommonNeRF(nn.Module):
 
   # gets the current latent vector for this NeRF instance
   def curr_latent(self, pts_shape) -> ["T", "B", "H", "W", "L_pp + L_inst"]:
-    curr = self.empty_latent.expand(pts_shape[:-1] + (0,)) if self.per_pt_latent is None \
+    curr = self.empty_latent.new_zeros(pts_shape[:-1] + (0,)) if self.per_pt_latent is None \
       else self.per_pt_latent
 
     if self.per_pixel_latent is not None:
@@ -246,23 +626,25 @@ class TinyNeRF(CommonNeRF):
     )
 
   def forward(self, rays):
-    pts, ts, r_o, r_d = compute_pts_ts(
-      rays, self.t_near, self.t_far, self.steps,
-      perturb = 1 if self.training else 0,
-    )
+    pts, ts, r_o, r_d = self.sample_pts(rays)
     self.ts = ts
     return self.from_pts(pts, ts, r_o, r_d)
 
-  def from_pts(self, pts, ts, r_o, r_d):
+  def compute_density(self, pts, ts, r_o, r_d):
     latent = self.curr_latent(pts.shape)
     mip_enc = self.mip_encoding(r_o, r_d, ts)
     if mip_enc is not None: latent = torch.cat([latent, mip_enc], dim=-1)
+    return self.estim(pts, latent)[..., 0]
 
-    density, feats = self.estim(pts, latent).split([1, 3], dim=-1)
+  def shade_density(self, pts, ts, r_o, r_d, mask=None):
+    latent = self.curr_latent(pts.shape)
+    mip_enc = self.mip_encoding(r_o, r_d, ts)
+    if mip_enc is not None: latent = torch.cat([latent, mip_enc], dim=-1)
 
-    self.alpha, self.weights = alpha_from_density(density, ts, r_d)
-    return volumetric_integrate(self.weights, self.feat_act(feats)) + \
-      self.sky_color(None, self.weights)
+    density, feats = sparse_eval(mask, self.estim, pts, latent).split([1, 3], dim=-1)
+    return self.skip_empty(mask, density[..., 0]), feats
+  # color comes out of the same MLP as density, so there is nothing left to skip.
+  def shade_color(self, feats, pts, ts, r_o, r_d, mask=None): return self.feat_act(feats)
 
 # A plain old nerf
 class PlainNeRF(CommonNeRF):
@@ -270,6 +652,8 @@ class PlainNeRF(CommonNeRF):
     self,
     intermediate_size: int = 32,
     out_features: int = 3,
+    # spatial encoder, defaults to fourier features
+    enc=None,
 
     device: torch.device = "cuda",
 
@@ -278,11 +662,12 @@ class PlainNeRF(CommonNeRF):
     super().__init__(**kwargs, device=device)
     self.latent_size = self.total_latent_size()
 
+    if enc is None: enc = FourierEncoder(input_dims=3, device=device)
+    small = isinstance(enc, feature_grid_encoders)
     self.first = SkipConnMLP(
-      in_size=3, out=1 + intermediate_size, latent_size=self.latent_size,
-      enc=FourierEncoder(input_dims=3, device=device),
+      in_size=3, out=1 + intermediate_size, latent_size=self.latent_size, enc=enc,
 
-      num_layers = 6, hidden_size = 128, xavier_init=True,
+      num_layers = 2 if small else 6, hidden_size = 64 if small else 128, xavier_init=True,
     )
 
     self.refl = refl.View(
@@ -291,13 +676,17 @@ class PlainNeRF(CommonNeRF):
     )
 
   def forward(self, rays):
-    pts, ts, r_o, r_d = compute_pts_ts(
-      rays, self.t_near, self.t_far, self.steps, perturb = 1 if self.training else 0,
-    )
+    pts, ts, r_o, r_d = self.sample_pts(rays)
     self.ts = ts
     return self.from_pts(pts, ts, r_o, r_d)
 
-  def from_pts(self, pts, ts, r_o, r_d):
+  def compute_density(self, pts, ts, r_o, r_d):
+    latent = self.curr_latent(pts.shape)
+    mip_enc = self.mip_encoding(r_o, r_d, ts)
+    if mip_enc is not None: latent = torch.cat([latent, mip_enc], dim=-1)
+    return self.first(pts, latent if latent.shape[-1] != 0 else None)[..., 0]
+
+  def shade_density(self, pts, ts, r_o, r_d, mask=None):
     latent = self.curr_latent(pts.shape)
 
     mip_enc = self.mip_encoding(r_o, r_d, ts)
@@ -305,25 +694,23 @@ class PlainNeRF(CommonNeRF):
     # If there is a mip encoding, stack it with the latent encoding.
     if mip_enc is not None: latent = torch.cat([latent, mip_enc], dim=-1)
 
-    first_out = self.first(pts, latent if latent.shape[-1] != 0 else None)
+    first_out = sparse_eval(mask, self.first, pts, latent if latent.shape[-1] != 0 else None)
 
     density = first_out[..., 0]
     if self.training and self.noise_std > 0:
       density = density + torch.randn_like(density) * self.noise_std
+    density = self.skip_empty(mask, density)
 
     intermediate = first_out[..., 1:]
-
+    return density, torch.cat([latent, intermediate], dim=-1)
+  def shade_color(self, feats, pts, ts, r_o, r_d, mask=None):
     #n = None
     #if self.refl.can_use_normal: n = autograd(pts, density)
 
     view = r_d[None, ...].expand_as(pts)
-    rgb = self.refl(
-      x=pts, view=view,
-      latent=torch.cat([latent, intermediate], dim=-1),
-    )
-
-    self.alpha, self.weights = alpha_from_density(density, ts, r_d)
-    return volumetric_integrate(self.weights, rgb) + self.sky_color(view, self.weights)
+    return sparse_eval(mask, self.refl, x=pts, view=view, latent=feats)
+  def background(self, r_d, weights):
+    return self.sky_color(r_d[None, ...].expand(weights.shape + (3,)), weights)
 
 # NeRF with a thin middle layer, for encoding information
 class NeRFAE(CommonNeRF):
@@ -334,6 +721,8 @@ class NeRFAE(CommonNeRF):
 
     encoding_size: int = 32,
     normalize_latent: bool = True,
+    # spatial encoder, defaults to fourier features
+    enc=None,
 
     device="cuda",
     **kwargs,
@@ -342,11 +731,13 @@ class NeRFAE(CommonNeRF):
 
     self.latent_size = self.total_latent_size()
 
+    if enc is None: enc = FourierEncoder(input_dims=3, device=device)
+    small = isinstance(enc, feature_grid_encoders)
     self.encode = SkipConnMLP(
       in_size=3, out=encoding_size,
       latent_size=self.latent_size,
-      num_layers=5, hidden_size=128,
-      enc=FourierEncoder(input_dims=3, device=device),
+      num_layers=2 if small else 5, hidden_size=64 if small else 128,
+      enc=enc,
       xavier_init=True,
     )
 
@@ -367,20 +758,24 @@ class NeRFAE(CommonNeRF):
     self.regularize_latent = True
     self.latent_l2_loss = 0
   def forward(self, rays):
-    pts, ts, r_o, r_d = compute_pts_ts(
-      rays, self.t_near, self.t_far, self.steps,
-      perturb = 1 if self.training else 0,
-    )
+    pts, ts, r_o, r_d = self.sample_pts(rays)
     self.ts = ts
     return self.from_pts(pts, ts, r_o, r_d)
 
-  def from_pts(self, pts, ts, r_o, r_d):
+  def compute_density(self, pts, ts, r_o, r_d):
     encoded = self.compute_encoded(pts, ts, r_o, r_d)
+    if self.normalize_latent: encoded = F.normalize(encoded, dim=-1)
+    return self.density_tform(encoded)[..., 0]
+
+  def shade_density(self, pts, ts, r_o, r_d, mask=None):
+    encoded = self.compute_encoded(pts, ts, r_o, r_d, mask=mask)
     if self.regularize_latent:
       self.latent_l2_loss = torch.linalg.norm(encoded, dim=-1).square().mean()
-    return self.from_encoded(encoded, ts, r_d, pts)
+    return self.density_encoded(encoded, mask=mask)
+  def shade_color(self, feats, pts, ts, r_o, r_d, mask=None):
+    return self.color_encoded(feats, r_d, pts, mask=mask)
 
-  def compute_encoded(self, pts, ts, r_o, r_d):
+  def compute_encoded(self, pts, ts, r_o, r_d, mask=None):
     latent = self.curr_latent(pts.shape)
 
     mip_enc = self.mip_encoding(r_o, r_d, ts)
@@ -388,27 +783,101 @@ class NeRFAE(CommonNeRF):
     # If there is a mip encoding, stack it with the latent encoding.
     if mip_enc is not None: latent = torch.cat([latent, mip_enc], dim=-1)
 
-    return self.encode(pts, latent if latent.shape[-1] != 0 else None)
-  def from_encoded(self, encoded, ts, r_d, pts):
+    return sparse_eval(mask, self.encode, pts, latent if latent.shape[-1] != 0 else None)
+  def from_encoded(self, encoded, ts, r_d, pts, mask=None):
+    density, rgb = self.shade_encoded(encoded, r_d, pts, mask=mask)
+    self.alpha, self.weights = alpha_from_density(density, ts, r_d)
+
+    color = volumetric_integrate(self.weights, rgb)
+    sky = self.sky_color(None, self.weights)
+    return color + sky
+  def shade_encoded(self, encoded, r_d, pts, mask=None):
+    density, feats = self.density_encoded(encoded, mask=mask)
+    return density, self.color_encoded(feats, r_d, pts, mask=mask)
+  def density_encoded(self, encoded, mask=None):
     if self.normalize_latent: encoded = F.normalize(encoded, dim=-1)
 
-    first_out = self.density_tform(encoded)
+    first_out = sparse_eval(mask, self.density_tform, encoded)
     density = first_out[..., 0]
     intermediate = first_out[..., 1:]
 
     if self.training and self.noise_std > 0:
       density = density + torch.randn_like(density) * self.noise_std
+    density = self.skip_empty(mask, density)
+    return density, torch.cat([encoded,intermediate],dim=-1)
+  def color_encoded(self, feats, r_d, pts, mask=None):
+    return sparse_eval(mask, self.refl, x=pts, view=r_d[None,...].expand_as(pts), latent=feats)
+
+# An MLP-free NeRF, which stores density and spherical harmonic coefficients in a dense voxel
+# grid that is trilinearly interpolated, as in Plenoxels (https://arxiv.org/abs/2112.05131).
+class GridNeRF(CommonNeRF):
+  def __init__(
+    self,
+    resolution: int = 128,
+    # the grid covers [-bound, bound]^3, anything outside of it is empty.
+    bound: float = 1.5,
+    sh_order: int = 2,
+    out_features: int = 3,
 
-    rgb = self.refl(
-      x=pts, view=r_d[None,...].expand_as(pts),
-      latent=torch.cat([encoded,intermediate],dim=-1),
-    )
+    device="cuda",
+    **kwargs,
+  ):
+    super().__init__(**kwargs, device=device)
+    assert(self.mip is None), "Voxel grids do not support mip"
+    assert(self.total_latent_size() == 0), "Voxel grids do not support latent codes"
+    self.bound = bound
+    self.sh_order = sh_order
+    self.out_features = out_features
+    R = resolution
+    # density starts low so that the initial volume is mostly transparent.
+    self.density = nn.Parameter(torch.full((1, 1, R, R, R), -4., device=device))
+    K = (sh_order + 1) ** 2
+    self.sh = nn.Parameter(torch.zeros(1, out_features * K, R, R, R, device=device))
 
-    self.alpha, self.weights = alpha_from_density(density, ts, r_d)
+  def forward(self, rays):
+    pts, ts, r_o, r_d = self.sample_pts(rays)
+    self.ts = ts
+    return self.from_pts(pts, ts, r_o, r_d)
 
-    color = volumetric_integrate(self.weights, rgb)
-    sky = self.sky_color(None, self.weights)
-    return color + sky
+  @property
+  def resolution(self): return self.density.shape[-1]
+  # trilinearly interpolates a grid [1, C, R, R, R] at pts, returning [..., C].
+  def interp(self, grid, pts):
+    g = (pts / self.bound).reshape(1, -1, 1, 1, 3)
+    out = F.grid_sample(grid, g, mode="bilinear", align_corners=True)
+    return out.reshape(grid.shape[1], -1).t().reshape(pts.shape[:-1] + (-1,))
+  def inside(self, pts): return (pts.abs() <= self.bound).all(dim=-1)
+
+  def compute_density(self, pts, ts, r_o, r_d):
+    return self.skip_empty(self.inside(pts), self.interp(self.density, pts)[..., 0])
+  def shade_density(self, pts, ts, r_o, r_d, mask=None):
+    density = self.compute_density(pts, ts, r_o, r_d)
+    return self.skip_empty(mask, density), None
+  def shade_color(self, _feats, pts, ts, r_o, r_d, mask=None):
+    sh = sparse_eval(mask, lambda p: self.interp(self.sh, p), pts)
+    view = F.normalize(r_d[None, ...].expand_as(pts), dim=-1)
+    rgb = eval_sh(self.sh_order, sh.reshape(sh.shape[:-1] + (self.out_features, -1)), view)
+    return self.feat_act(rgb)
+  def background(self, r_d, weights):
+    return self.sky_color(r_d[None, ...].expand(weights.shape + (3,)), weights)
+
+  # total variation of the grids, encouraging neighbouring voxels to be similar.
+  def tv_loss(self):
+    tv = 0
+    for grid in [self.density, self.sh]:
+      for dim in [2, 3, 4]: tv = tv + torch.diff(grid, dim=dim).square().mean()
+    return tv
+  # resamples the grids to a higher resolution, the parameters are replaced so any optimizer
+  # must be given the new ones.
+  @torch.no_grad()
+  def upsample(self, resolution: int):
+    size = (resolution,) * 3
+    self.density = nn.Parameter(
+      F.interpolate(self.density.data, size=size, mode="trilinear", align_corners=True),
+    )
+    self.sh = nn.Parameter(
+      F.interpolate(self.sh.data, size=size, mode="trilinear", align_corners=True),
+    )
 
 def identity(x): return x
 # https://arxiv.org/pdf/2106.12052.pdf
@@ -535,38 +1004,78 @@ class VolSDF(CommonNeRF):
       out = out + missing
     return out
   def forward(self, rays):
-    pts, ts, r_o, r_d = compute_pts_ts(
-      rays, self.t_near, self.t_far, self.steps, perturb = 1 if self.training else 0,
-    )
+    pts, ts, r_o, r_d = self.sample_pts(rays)
     self.ts = ts
     return self.from_pts(pts, ts, r_o, r_d)
+  softplus_density = False
+  # converts sdf values to density using the cdf of the laplace distribution.
+  def sdf_density(self, sdf_vals):
+    scale = self.scale_act(self.scale) if self.training else 5e-3
+    return 1/scale * laplace_cdf(-sdf_vals, scale)
+  def compute_density(self, pts, ts, r_o, r_d):
+    sdf_vals, _ = self.sdf.from_pts(pts)
+    return self.sdf_density(sdf_vals)
   def total_latent_size(self): return self.sdf.latent_size
   def set_refl(self, refl): self.sdf.refl = refl
 
   @property
   def refl(self): return self.sdf.refl
 
-  def from_pts(self, pts, ts, r_o, r_d):
-    latent = self.curr_latent(pts.shape)
-    mip_enc = self.mip_encoding(r_o, r_d, ts)
-    if mip_enc is not None: latent = torch.cat([latent, mip_enc], dim=-1)
-
-    sdf_vals, latent = self.sdf.from_pts(pts)
+  def checkpoint_parts(self):
+    return { "density": [self.sdf.underlying], "refl": [self.sdf.refl], "integrator": [] }
+  def set_checkpoint(self, parts=[], chunk_size: int = 1 << 14):
+    super().set_checkpoint(parts, chunk_size)
+    # lit shading, including the integrator, is checkpointed in chunks of shaded samples.
+    self.integrator_chunk = chunk_size if "integrator" in parts else 0
+  @property
+  def can_pack(self) -> bool:
+    # lights and secondary bounces are batched per image.
+    if self.secondary is not None or isinstance(self.sdf.refl, refl.LightAndRefl): return False
+    return super().can_pack
+  @property
+  def per_sample_attrs(self):
+    return ("n",) if self.sdf.refl.can_use_normal or self.secondary is not None else ()
+  def background(self, r_d, weights): return 0
+  def shade_density(self, pts, ts, r_o, r_d, mask=None):
+    raw = sparse_eval(mask, self.sdf.underlying, pts)
+    sdf_vals, latent = raw[..., 0], raw[..., 1:]
+    if latent.shape[-1] == 0: latent = None
     # turn this line on if things are broken due to not having a scale_act.
     #if not hasattr(self, "scale_act"): self.scale_act = identity
-    scale = self.scale_act(self.scale) if self.training else 5e-3
-    density = 1/scale * laplace_cdf(-sdf_vals, scale)
-    self.alpha, self.weights = alpha_from_density(density, ts, r_d, softplus=False)
-
+    return self.skip_empty(mask, self.sdf_density(sdf_vals)), latent
+  def shade_color(self, latent, pts, ts, r_o, r_d, mask=None):
     n = None
     if self.sdf.refl.can_use_normal or self.secondary is not None:
-      self.n = n = F.normalize(self.sdf.normals(pts), dim=-1)
+      self.n = n = F.normalize(sparse_eval(mask, self.sdf.normals, pts), dim=-1)
 
     view = r_d.unsqueeze(0).expand_as(pts)
-    if self.secondary is None: rgb = self.sdf.refl(x=pts, view=view, normal=n, latent=latent)
-    else: rgb = self.secondary(r_o, self.weights, pts, view, n, latent)
-
-    return volumetric_integrate(self.weights, rgb)
+    if not isinstance(self.sdf.refl, refl.LightAndRefl):
+      return sparse_eval(mask, self.sdf.refl, x=pts, view=view, normal=n, latent=latent)
+    if mask is None: mask = torch.ones(pts.shape[:-1], dtype=torch.bool, device=pts.device)
+    # lights are per image, so each shaded sample gets its image's light, and samples are shaded
+    # as a batch of single sample rays [1, N, 1, 1] which the lights broadcast against.
+    img = mask.nonzero()[:, 1]
+    r_o = r_o.unsqueeze(0).expand(pts.shape[:-1] + (3,))
+    sub = lambda v: None if v is None else v[mask]
+    out = checkpoint_chunks(
+      self.shade_lit, getattr(self, "integrator_chunk", 0),
+      img, sub(r_o), sub(pts), sub(view), sub(n), sub(latent),
+    )
+    rgb = torch.zeros(mask.shape + out.shape[-1:], device=out.device, dtype=out.dtype)
+    rgb[mask] = out
+    return rgb
+  # shades [N] lit samples from image img [N], with the light of each sample's image set while
+  # shading, so that recomputing a checkpointed chunk uses the same lights.
+  def shade_lit(self, img, r_o, pts, view, n, latent):
+    light = self.sdf.refl.light
+    ray = lambda v: None if v is None else v[None, :, None, None]
+    self.sdf.refl.light = light[img]
+    try:
+      if self.secondary is None:
+        out = self.sdf.refl(x=ray(pts), view=ray(view), normal=ray(n), latent=ray(latent))
+      else: out = self.secondary(r_o[:, None, None], None, ray(pts), ray(view), ray(n), ray(latent))
+    finally: self.sdf.refl.light = light
+    return out[0, :, 0, 0]
   def set_sigmoid(self, kind="thin"):
     if not hasattr(self, "sdf"): return
     self.sdf.refl.act = load_sigmoid(kind)
@@ -619,6 +1128,9 @@ class AlternatingVolSDF(nn.Module):
 class DynamicNeRF(nn.Module):
   def __init__(self, canonical: CommonNeRF, gru_flow:bool=False, device="cuda"):
     super().__init__()
+    # samples are deformed before shading, so the canonical model cannot place fine samples.
+    assert(getattr(canonical, "fine_steps", 0) == 0), \
+      "Dynamic models do not support hierarchical sampling"
     self.canonical = canonical
 
     if gru_flow:
@@ -647,10 +1159,7 @@ class DynamicNeRF(nn.Module):
   def forward(self, rays_t):
     rays, t = rays_t
     device=rays.device
-    pts, ts, r_o, r_d = compute_pts_ts(
-      rays, self.canonical.t_near, self.canonical.t_far, self.canonical.steps,
-      perturb = 1 if self.training else 0,
-    )
+    pts, ts, r_o, r_d = self.canonical.ray_samples(rays, perturb = 1 if self.training else 0)
     self.ts = ts
     # small deviation for regularization
     if self.training and self.time_noise_std > 0:
@@ -671,6 +1180,8 @@ class DynamicNeRFAE(nn.Module):
   def __init__(self, canonical: NeRFAE, gru_flow: bool=False, device="cuda"):
     super().__init__()
     assert(isinstance(canonical, NeRFAE)), "Must use NeRFAE for DynamicNeRFAE"
+    assert(getattr(canonical, "fine_steps", 0) == 0), \
+      "Dynamic models do not support hierarchical sampling"
     self.canon = canonical.to(device)
 
     self.delta_estim = SkipConnMLP(
@@ -693,9 +1204,7 @@ class DynamicNeRFAE(nn.Module):
     rays, t = rays_t
     device=rays.device
 
-    pts, ts, r_o, r_d = compute_pts_ts(
-      rays, self.canon.t_near, self.canon.t_far, self.canon.steps,
-    )
+    pts, ts, r_o, r_d = self.canon.ray_samples(rays)
     self.ts = ts
     # small deviation for regularization
     if self.training and self.time_noise_std > 0: t = t + self.time_noise_std * torch.randn_like(t)
@@ -705,10 +1214,12 @@ class DynamicNeRFAE(nn.Module):
     delta = self.delta_estim(pts_t)
     #delta = torch.where(t.abs() < 1e-6, torch.zeros_like(delta), delta)
     dp, d_enc = delta.split([3, self.canon.encoding_size], dim=-1)
-    encoded = self.canon.compute_encoded(pts + dp, ts, r_o, r_d)
+    # only shade samples on rays which hit the bounds, and in occupied canonical space.
+    mask = self.canon.sample_mask(pts + dp)
+    encoded = self.canon.compute_encoded(pts + dp, ts, r_o, r_d, mask=mask)
 
     # TODO is this best as a sum, or is some other kind of tform better?
-    return self.canon.from_encoded(encoded + d_enc, ts, r_d, pts)
+    return self.canon.from_encoded(encoded + d_enc, ts, r_d, pts, mask=mask)
 
 class SinglePixelNeRF(nn.Module):
   def __init__(
@@ -806,36 +1317,13 @@ def metropolis_sampling(
       curr_density = torch.where(mask, density, curr_density)
   return curr, r_o + curr * r_d
 
-# TODO need to test this more, doesn't seem to work that well
+# Samples new ts along each ray proportionally to the weights of a density estimator.
 def inverse_sample(
   density_estimator,
   pts, ts, r_o, r_d,
 ):
   with torch.no_grad():
-    _, weights = alpha_from_density(density_estimator(pts.squeeze(-1)), ts, r_d)
-    weights = weights.clamp(min=1e-10)
-    pdf = weights/weights.sum(dim=0,keepdim=True)
-    cdf = torch.cumsum(pdf, dim=0)
-    N = ts.shape[0]
-    # XXX this only works because we assume that the number of samples (N) is the same.
-    #u = torch.rand_like(cdf)
-    u = torch.linspace(0, 1, N, device=cdf.device)\
-      [..., None, None, None].expand_as(cdf)
-    # XXX this operates on innermost dimension, so need to do this transpose
-    inds = torch.searchsorted(
-      cdf.transpose(0, -1).contiguous(), u.transpose(0, -1).contiguous(), right=True
-    ).transpose(0, -1)
-    below = (inds - 1).clamp(min=0)
-    above = inds.clamp(max=N-1)
-    inds_g = torch.stack([below, above], dim=-1)
-
-    # TODO what is the right dimension to add here?
-    cdf_g = torch.gather(cdf.unsqueeze(1).expand_as(inds_g), 0, inds_g)
-    bins_g = torch.gather(ts[:, None, None, None, None].expand_as(inds_g), 0, inds_g)
-
-    denom = cdf_g[..., 1] - cdf_g[..., 0]
-    denom = torch.where(denom < 1e-5, torch.ones_like(denom), denom)
-    t = (u - cdf_g[..., 0]) / denom
-    samples = bins_g[..., 0] + t * (bins_g[..., 1] - bins_g[..., 0])
-    new_pts = r_o + samples.unsqueeze(-1) * r_d
+    _, weights = alpha_from_density(density_estimator(pts).squeeze(-1), ts, r_d)
+    samples = sample_pdf(ts, weights, ts.shape[0])
+    new_pts = r_o.unsqueeze(0) + samples.unsqueeze(-1) * r_d.unsqueeze(0)
   return samples, new_pts
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import math
 import torchvision
 import torchvision.models as models
 import torchvision.transforms.functional as TVF
@@ -8,7 +9,7 @@ import torchvision.transforms.functional as TVF
 from itertools import chain
 from typing import Optional, Union
 
-from .utils import ( fourier, create_fourier_basis, smooth_min )
+from .utils import ( fourier, create_fourier_basis, smooth_min, checkpoint_chunks )
 
 class PositionalEncoder(nn.Module):
   def __init__(
@@ -63,6 +64,158 @@ class NNEncoder(nn.Module):
     assert(x.shape[-1] == self.fwd.in_features)
     return torch.sin(30 * self.fwd(x))
 
+# Multiresolution hash encoding from Instant-NGP (https://arxiv.org/abs/2201.05989).
+# Each level is a grid of learned features, stored densely if it fits in the table and hashed
+# otherwise, which are trilinearly interpolated and concatenated across levels.
+class HashEncoder(nn.Module):
+  def __init__(
+    self,
+    input_dims: int = 3,
+    levels: int = 16,
+    features: int = 2,
+    log2_table_size: int = 19,
+    base_res: int = 16,
+    max_res: int = 2048,
+    # inputs in [-bound, bound] are encoded, anything outside is clamped.
+    bound: float = 1.5,
+    # sparse gradients only update the table entries which were used, but require an optimizer
+    # which supports them, such as SparseAdam.
+    sparse: bool = False,
+    device="cpu",
+  ):
+    super().__init__()
+    assert(input_dims <= 3), "Hash encoding only supports up to 3 dimensions"
+    self.input_dims = input_dims
+    self.levels = levels
+    self.features = features
+    self.table_size = T = 1 << log2_table_size
+    self.bound = bound
+    self.sparse = sparse
+
+    growth = math.exp((math.log(max_res) - math.log(base_res))/max(levels-1, 1))
+    res = torch.tensor([math.floor(base_res * growth**l) for l in range(levels)], device=device)
+    self.register_buffer("res", res)
+    # levels which fit entirely in the table are indexed densely rather than hashed.
+    self.register_buffer("dense", (res + 1) ** input_dims <= T)
+    primes = [1, 2654435761, 805459861][:input_dims]
+    self.register_buffer("primes", torch.tensor(primes, device=device))
+    corners = torch.stack(torch.meshgrid(*[torch.arange(2, device=device)] * input_dims), dim=-1)
+    self.register_buffer("corners", corners.reshape(-1, input_dims))
+    self.register_buffer("level_offsets", torch.arange(levels, device=device) * T)
+    # all levels are stored in one table so they can be looked up in a single embedding.
+    self.table = nn.Parameter(1e-4 * (2 * torch.rand(levels * T, features, device=device) - 1))
+  def output_dims(self): return self.levels * self.features
+  def forward(self, x):
+    assert(x.shape[-1] == self.input_dims)
+    x = ((x + self.bound)/(2 * self.bound)).clamp(min=0, max=1)
+    # [L, N, D] position of each input in each level's grid
+    pos = x.unsqueeze(0) * self.res[:, None, None]
+    cell = pos.floor().long()
+    frac = pos - cell
+    # [L, N, 2^D, D] integer coordinates of each corner of each input's cell
+    c = cell.unsqueeze(2) + self.corners
+    stride = (self.res + 1)[:, None, None] ** torch.arange(self.input_dims, device=x.device)
+    dense_idx = (c * stride[:, None]).sum(dim=-1)
+    hashed = c[..., 0] * self.primes[0]
+    for i in range(1, self.input_dims): hashed = hashed ^ (c[..., i] * self.primes[i])
+    idx = torch.where(self.dense[:, None, None], dense_idx, hashed) % self.table_size
+    feats = F.embedding(idx + self.level_offsets[:, None, None], self.table, sparse=self.sparse)
+    # trilinear weights: frac along axes where the corner is 1, and 1 - frac otherwise
+    w = torch.where(self.corners.bool(), frac.unsqueeze(2), 1 - frac.unsqueeze(2)).prod(dim=-1)
+    out = (w.unsqueeze(-1) * feats).sum(dim=2)
+    return out.permute(1, 0, 2).reshape(x.shape[:-1] + (-1,))
+
+# Tensor decomposition encoding from TensoRF (https://arxiv.org/abs/2203.09517).
+# Features are sums of outer products of a line along each axis with a plane over the other two
+# (vm), or of lines along all three axes (cp), which are projected by a linear basis.
+class TensorEncoder(nn.Module):
+  def __init__(
+    self,
+    input_dims: int = 3,
+    kind: str = "vm",
+    components: int = 16,
+    resolution: int = 128,
+    features: int = 27,
+    # inputs in [-bound, bound] are encoded, anything outside has no features.
+    bound: float = 1.5,
+    device="cpu",
+  ):
+    super().__init__()
+    assert(input_dims == 3), "Tensor encoding only supports 3 dimensions"
+    assert(kind in ["vm", "cp"]), f"Unknown tensor decomposition {kind}"
+    self.input_dims = input_dims
+    self.kind = kind
+    self.bound = bound
+    C, R = components, resolution
+    self.lines = nn.ParameterList([
+      nn.Parameter(0.1 * torch.randn(1, C, R, 1, device=device)) for _ in range(3)
+    ])
+    if kind == "vm":
+      self.planes = nn.ParameterList([
+        nn.Parameter(0.1 * torch.randn(1, C, R, R, device=device)) for _ in range(3)
+      ])
+    self.basis = nn.Linear(3 * C if kind == "vm" else C, features, bias=False)
+  def output_dims(self): return self.basis.out_features
+  @property
+  def resolution(self): return self.lines[0].shape[2]
+  # samples a [1, C, H, W] grid at coords [N, 2] in [-1, 1] of (w, h), returning [C, N].
+  @staticmethod
+  def interp(grid, coords):
+    out = F.grid_sample(grid, coords.reshape(1, -1, 1, 2), mode="bilinear", align_corners=True)
+    return out.reshape(grid.shape[1], -1)
+  def forward(self, x):
+    assert(x.shape[-1] == self.input_dims)
+    p = (x / self.bound).reshape(-1, 3)
+    zeros = torch.zeros_like(p[:, :1])
+    # lines have a width of 1, so only their height coordinate matters.
+    lines = [
+      self.interp(line, torch.cat([zeros, p[:, i:i+1]], dim=-1))
+      for i, line in enumerate(self.lines)
+    ]
+    if self.kind == "cp": feats = lines[0] * lines[1] * lines[2]
+    else:
+      # each line is paired with the plane over the other two axes.
+      planes = [
+        self.interp(plane, p[:, [j, k]])
+        for plane, (j, k) in zip(self.planes, [(1, 2), (0, 2), (0, 1)])
+      ]
+      feats = torch.cat([l * pl for l, pl in zip(lines, planes)], dim=0)
+    return self.basis(feats.t()).reshape(x.shape[:-1] + (-1,))
+  # resamples the lines and planes to a higher resolution, the parameters are replaced so any
+  # optimizer must be given the new ones.
+  @torch.no_grad()
+  def upsample(self, resolution: int):
+    for i, l in enumerate(self.lines):
+      self.lines[i] = nn.Parameter(F.interpolate(
+        l.data, size=(resolution, 1), mode="bilinear", align_corners=True,
+      ))
+    if self.kind != "vm": return
+    for i, pl in enumerate(self.planes):
+      self.planes[i] = nn.Parameter(F.interpolate(
+        pl.data, size=(resolution, resolution), mode="bilinear", align_corners=True,
+      ))
+
+# encoders which store features in grids, so the MLP after them can be much smaller.
+feature_grid_encoders = (HashEncoder, TensorEncoder)
+
+# constructs the positional encoder for spatial inputs selected by args.
+def load_encoder(args, input_dims: int = 3):
+  if args.encoder == "fourier": return FourierEncoder(input_dims=input_dims)
+  elif args.encoder == "hash":
+    return HashEncoder(
+      input_dims=input_dims, levels=args.hash_levels, log2_table_size=args.hash_table_size,
+      max_res=args.hash_max_res, bound=args.hash_bound,
+      sparse=getattr(args, "hash_sparse", False),
+    )
+  elif args.encoder in ["tensor-vm", "tensor-cp"]:
+    return TensorEncoder(
+      input_dims=input_dims, kind=args.encoder.split("-")[1],
+      components=args.tensor_components, features=args.tensor_features,
+      resolution=args.tensor_init_res if args.tensor_init_res > 0 else args.tensor_res,
+      bound=args.tensor_bound,
+    )
+  else: raise NotImplementedError(f"Unknown encoder: {args.encoder}")
+
 class SkipConnMLP(nn.Module):
   "MLP with skip connections and fourier encoding"
   def __init__(
@@ -76,7 +229,9 @@ class SkipConnMLP(nn.Module):
     activation = nn.LeakyReLU(inplace=True),
     latent_size=0,
 
-    enc: Optional[Union[FourierEncoder, PositionalEncoder, NNEncoder]] = None,
+    enc: Optional[Union[
+      FourierEncoder, PositionalEncoder, NNEncoder, HashEncoder, TensorEncoder,
+    ]] = None,
 
     # Record the last layers activation
     last_layer_act = False,
@@ -125,6 +280,14 @@ class SkipConnMLP(nn.Module):
     self.last_layer_act = last_layer_act
 
   def forward(self, p, latent: Optional[torch.Tensor]=None):
+    chunk_size = getattr(self, "checkpoint_chunk", 0)
+    # the last layer is recorded for the whole batch, which chunks would overwrite.
+    if chunk_size <= 0 or self.last_layer_act: return self.mlp_forward(p, latent)
+    batches = p.shape[:-1]
+    if latent is not None: latent = latent.reshape(-1, self.latent_size)
+    out = checkpoint_chunks(self.mlp_forward, chunk_size, p.reshape(-1, p.shape[-1]), latent)
+    return out.reshape(batches + out.shape[-1:])
+  def mlp_forward(self, p, latent: Optional[torch.Tensor]=None):
     batches = p.shape[:-1]
     init = p.reshape(-1, p.shape[-1])
 
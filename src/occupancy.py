@@ -0,0 +1,68 @@
+# occupancy.py contains a grid over the scene bounds which marks which cells contain any
+# density, so that samples in empty cells can be skipped before evaluating any MLP.
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+class OccupancyGrid(nn.Module):
+  def __init__(
+    self,
+    resolution: int = 64,
+    # the grid covers [-bound, bound]^3, anything outside of it is considered empty.
+    bound: float = 1.5,
+    # alpha below which a cell is considered empty
+    threshold: float = 1e-2,
+    # how quickly old estimates of a cell's alpha are forgotten
+    decay: float = 0.95,
+    device="cuda",
+  ):
+    super().__init__()
+    self.resolution = R = resolution
+    self.bound = bound
+    self.threshold = threshold
+    self.decay = decay
+    # initially everything is occupied, so nothing is skipped until the first update.
+    self.register_buffer("alphas", torch.ones(R, R, R, device=device))
+    self.register_buffer("bits", torch.ones(R, R, R, dtype=torch.bool, device=device))
+
+  def cell_size(self): return 2 * self.bound / self.resolution
+  # fraction of cells which are occupied
+  def occupancy(self): return self.bits.float().mean().item()
+
+  # returns for each point whether it lies inside an occupied cell.
+  def forward(self, pts):
+    R = self.resolution
+    idxs = ((pts + self.bound) / self.cell_size()).floor().long()
+    inside = ((idxs >= 0) & (idxs < R)).all(dim=-1)
+    x, y, z = idxs.clamp(min=0, max=R-1).unbind(dim=-1)
+    return self.bits[x, y, z] & inside
+
+  # refreshes the grid by evaluating density_fn at a random point in every cell.
+  # step_size is the expected distance between samples along a ray, used to convert to alpha.
+  @torch.no_grad()
+  def update(
+    self,
+    density_fn,
+    step_size: float,
+    softplus: bool = True,
+    chunk_size: int = 1 << 16,
+  ):
+    R = self.resolution
+    device = self.bits.device
+    cells = torch.stack(torch.meshgrid(
+      torch.arange(R, device=device),
+      torch.arange(R, device=device),
+      torch.arange(R, device=device),
+    ), dim=-1).reshape(-1, 3)
+    alphas = []
+    for c in cells.split(chunk_size, dim=0):
+      pts = (c + torch.rand(c.shape, device=device)) * self.cell_size() - self.bound
+      density = density_fn(pts).reshape(-1)
+      sigma_a = F.softplus(density-1) if softplus else F.relu(density)
+      alphas.append(1 - torch.exp(-sigma_a * step_size))
+    alphas = torch.cat(alphas, dim=0).reshape(R, R, R)
+    self.alphas.copy_(torch.maximum(self.alphas * self.decay, alphas))
+    # if the scene is mostly transparent, the threshold is lowered so it is not entirely empty.
+    threshold = min(self.threshold, self.alphas.mean().item())
+    self.bits.copy_(self.alphas > threshold)
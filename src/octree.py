@@ -0,0 +1,215 @@
+# octree.py contains a sparse voxel octree with spherical harmonic leaves, which a trained NeRF
+# can be baked into so that it can be rendered without evaluating any MLP, as in PlenOctrees
+# (https://arxiv.org/abs/2103.14024).
+
+import math
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from .spherical_harmonics import eval_sh
+from .utils import ( ray_aabb )
+
+# orders cells at a resolution of res by x, then y, then z.
+def cell_keys(coords, res: int): return (coords[:, 0] * res + coords[:, 1]) * res + coords[:, 2]
+
+# builds the child table of an octree from the integer coordinates of its leaves.
+# Nodes of each level are stored contiguously, and children are -1 if the child is empty.
+def build_children(coords, depth: int):
+  levels = [torch.unique(coords >> (depth - l), dim=0) for l in range(depth+1)]
+  offsets = [0]
+  for nodes in levels: offsets.append(offsets[-1] + nodes.shape[0])
+  child = torch.full((offsets[-1], 8), -1, dtype=torch.long, device=coords.device)
+  octant_weights = torch.tensor([4, 2, 1], device=coords.device)
+  for l in range(depth):
+    parents, kids = levels[l], levels[l+1]
+    parent_idxs = torch.searchsorted(cell_keys(parents, 1 << l), cell_keys(kids >> 1, 1 << l))
+    octants = ((kids & 1) * octant_weights).sum(dim=-1)
+    child[offsets[l] + parent_idxs, octants] = \
+      offsets[l+1] + torch.arange(kids.shape[0], device=coords.device)
+  return child, offsets
+
+# points evenly distributed over the unit sphere.
+def fibonacci_sphere(n: int, device="cuda"):
+  i = torch.arange(n, device=device, dtype=torch.float) + 0.5
+  phi = torch.acos(1 - 2 * i/n)
+  theta = math.pi * (1 + math.sqrt(5)) * i
+  return torch.stack([
+    theta.cos() * phi.sin(), theta.sin() * phi.sin(), phi.cos(),
+  ], dim=-1)
+
+class SparseVoxelOctree(nn.Module):
+  def __init__(
+    self,
+    # [L, 3] integer coordinates of each leaf at a resolution of 2^depth
+    coords,
+    # [L] density of each leaf
+    density,
+    # [L, 3, (sh_order+1)^2] spherical harmonic coefficients of each leaf, in logit space
+    sh,
+    depth: int,
+    # the octree covers [-bound, bound]^3
+    bound: float = 1.5,
+    sh_order: int = 2,
+    t_near: float = 0,
+    t_far: float = 1,
+    bg: str = "black",
+    # rays are terminated once their transmittance drops below this.
+    min_transmittance: float = 1e-3,
+  ):
+    super().__init__()
+    assert((sh_order + 1) ** 2 == sh.shape[-1]), "Mismatched spherical harmonic order"
+    self.depth = depth
+    self.bound = bound
+    self.sh_order = sh_order
+    self.t_near = t_near
+    self.t_far = t_far
+    self.bg = bg
+    self.min_transmittance = min_transmittance
+
+    # leaves are stored in the same order as the last level of nodes.
+    order = torch.argsort(cell_keys(coords, 1 << depth))
+    child, self.offsets = build_children(coords[order], depth)
+    self.register_buffer("child", child)
+    self.register_buffer("octant_weights", torch.tensor([4, 2, 1], device=coords.device))
+    self.density = nn.Parameter(density[order].clone())
+    self.sh = nn.Parameter(sh[order].clone())
+
+  def num_leaves(self): return self.density.shape[0]
+
+  # returns for each point the index of its leaf, or -1 if it is in empty space, and the level
+  # of the node containing it, which is the depth for leaves.
+  def lookup(self, pts):
+    D = self.depth
+    R = 1 << D
+    q = ((pts + self.bound) / (2 * self.bound) * R).floor().long()
+    inside = ((q >= 0) & (q < R)).all(dim=-1)
+    q = q.clamp(min=0, max=R-1)
+    node = inside.long() - 1
+    level = torch.zeros_like(node)
+    for l in range(D):
+      alive = node >= 0
+      octant = (((q >> (D - l - 1)) & 1) * self.octant_weights).sum(dim=-1)
+      node = torch.where(alive, self.child[node.clamp(min=0), octant], node)
+      level = level.masked_fill(alive, l + 1)
+    leaf = torch.where(node >= 0, node - self.offsets[D], node)
+    return leaf, level
+
+  # distance along each ray where it enters and leaves the octree's bounds
+  def clip(self, r_o, r_d):
+    t_enter, t_exit = ray_aabb(r_o, r_d, -self.bound, self.bound)
+    return t_enter.clamp(min=self.t_near), t_exit.clamp(max=self.t_far)
+
+  # renders rays [..., 6] by traversing the octree along each ray, skipping whole empty nodes
+  # and integrating each leaf exactly, since its density and color are constant inside it.
+  def forward(self, rays):
+    r_o, r_d = rays.split([3,3], dim=-1)
+    shape = r_o.shape[:-1]
+    r_o, r_d = r_o.reshape(-1, 3), r_d.reshape(-1, 3)
+    N = r_o.shape[0]
+    t, t_end = self.clip(r_o, r_d)
+    trans = torch.ones(N, device=r_o.device, dtype=r_o.dtype)
+    color = torch.zeros(N, 3, device=r_o.device, dtype=r_o.dtype)
+    active = torch.arange(N, device=r_o.device)
+
+    leaf_size = 2 * self.bound / (1 << self.depth)
+    # every step leaves at least one node, so rays never take more steps than this.
+    max_steps = 3 * (1 << self.depth) * (self.depth + 1)
+    # dropping finished rays needs their count on the host, so it is only done every few steps,
+    # and rays which finish in between are carried along without contributing.
+    compact_every = 8
+    for step in range(max_steps):
+      if step % compact_every == 0:
+        active = active[(t[active] < t_end[active]) & (trans[active] > self.min_transmittance)]
+        if active.numel() == 0: break
+      o, d, ta = r_o[active], r_d[active], t[active]
+      running = (ta < t_end[active]) & (trans[active] > self.min_transmittance)
+      pts = o + d * (ta + 1e-4 * leaf_size).unsqueeze(-1)
+      leaf, level = self.lookup(pts)
+
+      size = (2 * self.bound * torch.pow(0.5, level.to(d.dtype))).unsqueeze(-1)
+      cube_min = ((pts + self.bound)/size).floor() * size - self.bound
+      far = cube_min + (d > 0) * size
+      inv_d = 1/torch.where(d.abs() < 1e-8, torch.full_like(d, 1e-8), d)
+      t_exit = torch.minimum(((far - o) * inv_d).min(dim=-1)[0], t_end[active])
+
+      # rays in empty space or which are done have no alpha, instead of being selected out.
+      hit = (leaf >= 0) & running
+      leaf = leaf.clamp(min=0)
+      delta = (t_exit - ta).clamp(min=0) * torch.linalg.norm(d, dim=-1)
+      delta = torch.where(hit, delta, torch.zeros_like(delta))
+      alpha = 1 - torch.exp(-F.relu(self.density[leaf]) * delta)
+      rgb = eval_sh(self.sh_order, self.sh[leaf], F.normalize(d, dim=-1)).sigmoid()
+      w = trans[active] * alpha
+      color = color.index_add(0, active, w.unsqueeze(-1) * rgb)
+      trans = trans.index_put((active,), trans[active] * (1 - alpha))
+      t[active] = torch.where(running, t_exit, ta)
+
+    self.acc = (1 - trans).reshape(shape + (1,))
+    if self.bg == "white": color = color + trans.unsqueeze(-1)
+    return color.reshape(shape + (3,))
+
+# Bakes a CommonNeRF into an octree with leaves at a resolution of 2^depth. Density is sampled
+# on the dense grid and cells below alpha threshold are pruned, then view dependent color of
+# each leaf is projected onto spherical harmonics from many directions.
+@torch.no_grad()
+def bake(
+  nerf,
+  depth: int = 8,
+  bound: float = 1.5,
+  sh_order: int = 2,
+  threshold: float = 1e-2,
+  # number of jittered density samples taken in each cell.
+  samples: int = 4,
+  # number of view directions used to project color onto spherical harmonics.
+  num_dirs: int = 128,
+  chunk_size: int = 1 << 16,
+  bg: str = "black",
+  min_transmittance: float = 1e-3,
+):
+  assert(nerf.mip is None), "Cannot bake a NeRF with a mip encoding"
+  was_training = nerf.training
+  nerf.eval()
+  device = nerf.empty_latent.device
+  R = 1 << depth
+  cell = 2 * bound/R
+
+  yz = torch.stack(torch.meshgrid(
+    torch.arange(R, device=device), torch.arange(R, device=device),
+  ), dim=-1).reshape(-1, 2)
+  coords, densities = [], []
+  for x in range(R):
+    c = torch.cat([torch.full_like(yz[:, :1], x), yz], dim=-1)
+    occupied = nerf.occupied((c + 0.5) * cell - bound)
+    if occupied is not None: c = c[occupied]
+    if c.shape[0] == 0: continue
+    pts = (c.unsqueeze(0) + torch.rand(samples, *c.shape, device=device)) * cell - bound
+    density = nerf.compute_density(pts.reshape(-1, 3), None, None, None).reshape(samples, -1)
+    if nerf.softplus_density: sigma = F.softplus(density-1)
+    else: sigma = F.relu(density)
+    keep = (1 - torch.exp(-sigma.max(dim=0)[0] * cell)) > threshold
+    coords.append(c[keep])
+    densities.append(sigma.mean(dim=0)[keep])
+  coords = torch.cat(coords, dim=0)
+  densities = torch.cat(densities, dim=0)
+  assert(coords.shape[0] > 0), "Nothing left to bake after pruning, try a lower threshold"
+
+  K = (sh_order + 1) ** 2
+  dirs = fibonacci_sphere(num_dirs, device=device)
+  basis = eval_sh(sh_order, torch.eye(K, device=device).expand(num_dirs, K, K), dirs)
+  proj = torch.linalg.pinv(basis)
+  shs = []
+  for c in coords.split(max(chunk_size // num_dirs, 1), dim=0):
+    n = c.shape[0]
+    pts = ((c + 0.5) * cell - bound).unsqueeze(0).expand(num_dirs, n, 3).reshape(1, -1, 3)
+    r_d = dirs.unsqueeze(1).expand(num_dirs, n, 3).reshape(-1, 3)
+    _, feats = nerf.shade_density(pts, None, None, r_d)
+    rgb = nerf.shade_color(feats, pts, None, None, r_d).reshape(num_dirs, n, -1)
+    logits = torch.logit(rgb[..., :3].clamp(min=1e-3, max=1-1e-3))
+    shs.append(torch.einsum("kd,dnc->nck", proj, logits))
+
+  nerf.train(was_training)
+  return SparseVoxelOctree(
+    coords, densities, torch.cat(shs, dim=0), depth=depth, bound=bound, sh_order=sh_order,
+    t_near=nerf.t_near, t_far=nerf.t_far, bg=bg, min_transmittance=min_transmittance,
+  )
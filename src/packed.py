@@ -0,0 +1,97 @@
+# packed.py contains a ragged representation of samples along rays. Each ray may have a
+# different number of samples, and all samples are stored contiguously in one flat buffer
+# ordered by ray, then by distance along the ray.
+
+import math
+import torch
+from dataclasses import dataclass
+
+from .utils import ( fp32 )
+
+@dataclass
+class PackedSamples:
+  # [N, 3] position of each sample
+  pts: torch.Tensor
+  # [N] distance along its ray of each sample
+  ts: torch.Tensor
+  # [N] distance from each sample to the next sample along its ray
+  dists: torch.Tensor
+  # [N] which ray each sample belongs to
+  ray_idxs: torch.Tensor
+  # [R] index of the first sample of each ray
+  offsets: torch.Tensor
+  # [R] number of samples of each ray
+  counts: torch.Tensor
+  # [R, 3] origin and direction of each ray
+  r_o: torch.Tensor
+  r_d: torch.Tensor
+  # if packed from a dense [T, ...] layout, the index of each sample in the flattened layout
+  dense_idxs: torch.Tensor = None
+  dense_shape: tuple = None
+
+  def __len__(self): return self.pts.shape[0]
+  @property
+  def num_rays(self) -> int: return self.counts.shape[0]
+  # expands a per ray value to every sample of that ray
+  def per_sample(self, v): return v[self.ray_idxs]
+  # scatters per sample values back into the dense layout they were packed from, zero filling
+  # samples which were not kept.
+  def unpack(self, v):
+    assert(self.dense_shape is not None), "Cannot unpack samples which were not packed"
+    out = v.new_zeros((math.prod(self.dense_shape),) + v.shape[1:])
+    out[self.dense_idxs] = v
+    return out.reshape(tuple(self.dense_shape) + v.shape[1:])
+
+# packs dense samples [T, B, H, W, 3] into a flat buffer, only keeping samples where keep is
+# true. dists are the distances between samples, as computed before dropping any.
+def pack(pts, ts, dists, r_o, r_d, keep=None) -> PackedSamples:
+  T = pts.shape[0]
+  ray_shape = pts.shape[1:-1]
+  R = math.prod(ray_shape)
+  device = pts.device
+  if len(ts.shape) == 1: ts = ts[:, None, None, None].expand(pts.shape[:-1])
+  if keep is None: keep = torch.ones(pts.shape[:-1], dtype=torch.bool, device=device)
+
+  # indices are ordered by ray then sample, so each ray's samples are contiguous.
+  flat = keep.reshape(T, R).t().reshape(-1).nonzero().squeeze(-1)
+  ray_idxs = torch.div(flat, T, rounding_mode="floor")
+  t_idxs = flat % T
+  dense_idxs = t_idxs * R + ray_idxs
+
+  counts = keep.reshape(T, R).sum(dim=0)
+  offsets = torch.cumsum(counts, dim=0) - counts
+  return PackedSamples(
+    pts=pts.reshape(T * R, 3)[dense_idxs],
+    ts=ts.reshape(T * R)[dense_idxs],
+    dists=dists.reshape(T * R)[dense_idxs],
+    ray_idxs=ray_idxs, offsets=offsets, counts=counts,
+    r_o=r_o.reshape(R, 3), r_d=r_d.reshape(R, 3),
+    dense_idxs=dense_idxs, dense_shape=(T,) + tuple(ray_shape),
+  )
+
+# sums the values of each sample along its ray, [N, ...] -> [R, ...]
+def segment_sum(v, packed: PackedSamples):
+  out = v.new_zeros((packed.num_rays,) + v.shape[1:])
+  return out.index_add(0, packed.ray_idxs, v)
+
+# exclusive product of (1 - alpha) along each ray, which is the transmittance up to each sample.
+def transmittance(alpha, packed: PackedSamples):
+  if len(packed) == 0: return torch.ones_like(alpha)
+  # scan in log space over the whole buffer, then subtract the sum at the start of each ray.
+  # Done in double since the running sum is over all rays rather than one.
+  log_t = (1.0 - alpha + 1e-10).double().log()
+  excl = torch.cumsum(log_t, dim=0) - log_t
+  start = excl[packed.offsets.clamp(max=len(packed)-1)]
+  return (excl - packed.per_sample(start)).exp().to(alpha.dtype)
+
+# packed version of alpha_from_density, returning per sample (alpha, weights).
+@fp32
+def alpha_from_density(density, packed: PackedSamples, softplus: bool = True):
+  if softplus: sigma_a = torch.nn.functional.softplus(density-1)
+  else: sigma_a = torch.nn.functional.relu(density)
+  alpha = 1 - torch.exp(-sigma_a * packed.dists)
+  return alpha, alpha * transmittance(alpha, packed)
+
+# packed version of volumetric_integrate, returning per ray [R, C] values.
+def volumetric_integrate(weights, other, packed: PackedSamples):
+  return segment_sum(weights[..., None] * other, packed)
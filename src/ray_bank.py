@@ -0,0 +1,74 @@
+# ray_bank.py contains a training sampler which draws independent random rays from every pixel
+# of every training image, instead of one crop shared by a few images, which gives much less
+# correlated batches.
+
+import torch
+
+# Rays are generated once, so cameras with learned parameters cannot be used as they would stop
+# receiving gradients. Instead of regenerating jittered rays, each sampled ray is jittered by up
+# to noise of a pixel along its image's per pixel change in ray, which is exact for pinhole
+# cameras with unnormalized directions and a first order approximation otherwise.
+class RayBank:
+  def __init__(
+    self,
+    cam,
+    # [I, H, W, C] labels of each image
+    labels,
+    size: int,
+    # [I] time of each image, if any
+    times=None,
+    # [I, ...] light of each image, if any
+    light=None,
+    # number of images to generate rays for at once
+    chunk_size: int = 8,
+    # how much to jitter rays within their pixel when sampled, as in sample_crop's with_noise
+    noise: float = 0,
+  ):
+    assert(labels.shape[1] == size and labels.shape[2] == size), \
+      "Ray bank requires labels at the render size"
+    assert(not any(torch.is_tensor(v) and v.requires_grad for v in vars(cam).values())), \
+      "Ray bank cannot be used with learned cameras"
+    self.num_images = len(cam)
+    self.pixels = size * size
+    device = labels.device
+    crop = (0, 0, size, size)
+    with torch.no_grad():
+      self.rays = torch.cat([
+        cam[i:i+chunk_size].sample_crop(crop, size=size, device=device).reshape(-1, 6)
+        for i in range(0, self.num_images, chunk_size)
+      ], dim=0)
+      # [I, 2, 6] change in ray from moving one pixel in u and in v.
+      corner = cam.sample_crop((0, 0, 2, 2), size=size, device=device)
+      self.pixel_deltas = torch.stack([
+        corner[:, 0, 1] - corner[:, 0, 0], corner[:, 1, 0] - corner[:, 0, 0],
+      ], dim=1)
+    self.noise = noise
+    self.labels = labels.reshape(-1, labels.shape[-1])
+    self.times = times
+    self.light = light
+
+  def __len__(self): return self.rays.shape[0]
+
+  # draws n random rays, returning flat indices of the image and the pixel of each.
+  # If stratified, every image gets an equal share of the rays.
+  def sample_idxs(self, n: int, stratified: bool = False):
+    device = self.rays.device
+    if not stratified: return torch.randint(len(self), (n,), device=device)
+    offset = torch.randint(self.num_images, (1,), device=device)
+    imgs = (torch.arange(n, device=device) + offset) % self.num_images
+    return imgs * self.pixels + torch.randint(self.pixels, (n,), device=device)
+
+  # returns n rays as a [n, 1, 1, 6] batch, so each ray is its own batch item, with their labels
+  # [n, 1, 1, C], times [n] and lights.
+  def sample(self, n: int, stratified: bool = False):
+    idxs = self.sample_idxs(n, stratified)
+    imgs = torch.div(idxs, self.pixels, rounding_mode="floor")
+    rays = self.rays[idxs]
+    if self.noise > 0:
+      jitter = (torch.rand(n, 2, 1, device=rays.device) - 0.5) * self.noise
+      rays = rays + (jitter * self.pixel_deltas[imgs]).sum(dim=1)
+    rays = rays[:, None, None, :]
+    labels = self.labels[idxs][:, None, None, :]
+    times = None if self.times is None else self.times[imgs]
+    light = None if self.light is None else self.light[imgs]
+    return rays, labels, times, light
@@ -44,7 +44,7 @@ class LightingWIsect(nn.Module):
   def forward(self, pts, lights, isect_fn, latent=None, mask=None):
     pts = pts if mask is None else pts[mask]
     dir, dist, spectrum = lights(pts, mask=mask)
-    far = dist.max().item() if mask.any() else 6
+    far = dist.max().item() if dist.numel() > 0 else 6
     visible = isect_fn(pts, dir, near=0.1, far=far)
     spectrum = torch.where(
       visible[...,None],
@@ -67,7 +67,7 @@ class LearnedLighting(nn.Module):
   def forward(self, pts, lights, isect_fn, latent=None, mask=None):
     pts = pts if mask is None else pts[mask]
     dir, dist, spectrum = lights(pts, mask=mask)
-    far = dist.max().item() if mask.any() else 6
+    far = dist.max().item() if dist.numel() > 0 else 6
     # TODO why doesn't this isect fn seem to work?
     visible = isect_fn(r_o=pts, r_d=dir, near=2e-3, far=3, eps=1e-3)
     att = self.attenuation(torch.cat([pts, dir], dim=-1), latent).sigmoid()
@@ -5,8 +5,10 @@ import torch.optim as optim
 import random
 
 from .nerf import ( CommonNeRF, compute_pts_ts )
-from .neural_blocks import ( SkipConnMLP, FourierEncoder, NNEncoder )
-from .utils import ( autograd, eikonal_loss, smooth_min )
+from .neural_blocks import (
+  SkipConnMLP, FourierEncoder, NNEncoder, feature_grid_encoders, load_encoder,
+)
+from .utils import ( autograd, eikonal_loss, smooth_min, fp32 )
 import src.refl as refl
 import src.march as march
 import src.renderers as renderers
@@ -20,7 +22,9 @@ def load(args, with_integrator:bool):
   elif args.sdf_kind == "triangles": cons = Triangles
   else: raise NotImplementedError(f"Unknown SDF kind: {args.sdf_kind}")
 
-  model = cons(latent_size=args.latent_size)
+  kwargs = { "latent_size": args.latent_size }
+  if args.sdf_kind == "mlp": kwargs["enc"] = load_encoder(args)
+  model = cons(**kwargs)
 
   if args.sphere_init: model.set_to_sphere()
 
@@ -29,7 +33,10 @@ def load(args, with_integrator:bool):
   refl_inst = refl.load(args, args.refl_kind, args.space_kind, model.latent_size)
   isect = march.load_intersection_kind(args.sdf_isect_kind)
 
-  sdf = SDF(model, refl_inst, isect=isect, t_near=args.near, t_far=args.far)
+  sdf = SDF(
+    model, refl_inst, isect=isect, t_near=args.near, t_far=args.far,
+    chunk_size=args.sdf_chunk_size,
+  )
   if args.integrator_kind is not None and with_integrator:
     return renderers.load(args, sdf, refl_inst)
 
@@ -44,6 +51,8 @@ class SDFModel(nn.Module):
     self.latent_size = latent_size
   def forward(self, _pts): raise NotImplementedError()
 
+  # normals are computed in fp32 under mixed precision, as double backward is sensitive to it.
+  @fp32
   def normals(self, pts, values = None):
     with torch.enable_grad():
       autograd_pts = pts if pts.requires_grad else pts.requires_grad_()
@@ -93,6 +102,8 @@ class SDF(nn.Module):
     t_near: float,
     t_far: float,
     alpha:int = 1000,
+    # max # of points the SDF is evaluated on at once while intersecting.
+    chunk_size: int = 1 << 18,
   ):
     super().__init__()
     assert(isinstance(underlying, SDFModel))
@@ -102,6 +113,7 @@ class SDF(nn.Module):
     self.near = t_near
     self.alpha = alpha
     self.isect=isect
+    self.chunk_size = chunk_size
 
   @property
   def sdf(self): return self
@@ -119,6 +131,7 @@ class SDF(nn.Module):
     pts, hit, t, tput = self.isect(
       self.underlying, r_o, r_d, near=self.near, far=self.far,
       eps=5e-5, iters=128 if self.training else 256,
+      chunk_size=getattr(self, "chunk_size", 1 << 18),
     )
     if self.training:
       if tput is None: tput = self.throughput(r_o, r_d)
@@ -132,12 +145,14 @@ class SDF(nn.Module):
         far=self.far if far is None else far,
         # since this is just for intersection, alright to use fewer steps
         iters=64 if self.training else 128,
+        chunk_size=getattr(self, "chunk_size", 1 << 18),
       )[1]
   def forward(self, rays, with_throughput=True):
     r_o, r_d = rays.split([3,3], dim=-1)
     pts, hit, t, tput = self.isect(
       self.underlying, r_o, r_d, near=self.near, far=self.far,
       iters=128 if self.training else 192,
+      chunk_size=getattr(self, "chunk_size", 1 << 18),
     )
     latent = None if self.latent_size == 0 else self.underlying(pts[hit])[..., 1:]
     out = torch.zeros_like(r_d)
@@ -167,7 +182,10 @@ class SDF(nn.Module):
     out[hit] = self.normals(pts[hit])
     return out
   def throughput(self, r_o, r_d):
-    tput, _best_pos = march.throughput(self.underlying, r_o, r_d, self.near, self.far)
+    tput, _best_pos = march.throughput(
+      self.underlying, r_o, r_d, self.near, self.far,
+      chunk_size=getattr(self, "chunk_size", 1 << 18),
+    )
     return -self.alpha*tput.unsqueeze(-1)
 
 
@@ -257,13 +275,17 @@ class Triangles(SDFModel):
 class MLP(SDFModel):
   def __init__(
     self,
+    # spatial encoder, defaults to fourier features
+    enc=None,
     **kwargs,
   ):
     super().__init__(**kwargs)
+    if enc is None: enc = FourierEncoder(input_dims=3)
+    small = isinstance(enc, feature_grid_encoders)
     self.mlp = SkipConnMLP(
       in_size=3, out=1+self.latent_size,
-      enc=FourierEncoder(input_dims=3),
-      num_layers=6, hidden_size=256,
+      enc=enc,
+      num_layers=3 if small else 6, hidden_size=64 if small else 256,
       xavier_init=True,
     )
   def forward(self, x): return self.mlp(x)
@@ -313,11 +335,13 @@ class SDFNeRF(nn.Module):
     sdf: SDF,
   ):
     super().__init__()
+    # the SDF's latent is computed for the nerf's uniform samples, so it cannot add fine samples.
+    assert(getattr(nerf, "fine_steps", 0) == 0), "Backing SDFs do not support hierarchical sampling"
     self.nerf = nerf
     self.sdf = sdf
     self.min_along_rays = None
   def forward(self, rays):
-    pts, ts, r_o, r_d = compute_pts_ts(rays, self.nerf.t_near, self.nerf.t_far, self.nerf.steps)
+    pts, ts, r_o, r_d = self.nerf.ray_samples(rays)
     sdf_vals = self.sdf(pts)
     # record mins along rays for backprop
     self.min_along_rays = sdf_vals.min(dim=0)[0]
@@ -1,9 +1,11 @@
+import functools
 import math
 import numpy as np
 import random
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.utils.checkpoint
 from PIL import Image
 import matplotlib.pyplot as plt
 
@@ -48,6 +50,32 @@ def integrated_pos_enc_diag(x, x_cov, min_deg:int, max_deg:int):
     torch.cat([y_var, y_var], dim=-1),
   )[0]
 
+# Runs fn with autocast disabled and its floating point tensor arguments cast to fp32, for
+# numerically sensitive functions used under mixed precision.
+def fp32(fn):
+  def cast(v): return v.float() if isinstance(v, torch.Tensor) and v.is_floating_point() else v
+  def run(args, kwargs):
+    return fn(*[cast(a) for a in args], **{ k: cast(v) for k, v in kwargs.items() })
+  @functools.wraps(fn)
+  def wrapper(*args, **kwargs):
+    with torch.autocast(device_type="cpu", enabled=False):
+      if not torch.cuda.is_available(): return run(args, kwargs)
+      with torch.autocast(device_type="cuda", enabled=False): return run(args, kwargs)
+  return wrapper
+
+# Evaluates fn with gradient checkpointing, in chunks of chunk_size along dim 0 of every tensor
+# argument, so only each chunk's inputs are kept for backward and its activations are
+# recomputed. The outputs of fn are concatenated along dim 0.
+def checkpoint_chunks(fn, chunk_size: int, *args):
+  if chunk_size <= 0 or not torch.is_grad_enabled(): return fn(*args)
+  N = next(a.shape[0] for a in args if isinstance(a, torch.Tensor))
+  outs = []
+  for s in range(0, N, chunk_size):
+    chunk = [a[s:s+chunk_size] if isinstance(a, torch.Tensor) else a for a in args]
+    outs.append(torch.utils.checkpoint.checkpoint(fn, *chunk, use_reentrant=False))
+  return torch.cat(outs, dim=0)
+
+@fp32
 def laplace_cdf(sdf_vals, scale):
   scaled = sdf_vals/scale
   return torch.where(
@@ -166,6 +194,25 @@ def rotate_vector(v, axis, c, s):
          + axis * (v * axis).sum(dim=-1, keepdim=True) * (1-c) \
          + torch.cross(axis, v, dim=-1) * s
 
+# distances along rays where they enter and exit an axis aligned box [lo, hi], where rays which
+# miss it exit before they enter.
+def ray_aabb(r_o, r_d, lo, hi):
+  inv_d = 1/torch.where(r_d.abs() < 1e-8, torch.full_like(r_d, 1e-8), r_d)
+  t0 = (lo - r_o) * inv_d
+  t1 = (hi - r_o) * inv_d
+  return torch.minimum(t0, t1).max(dim=-1)[0], torch.maximum(t0, t1).min(dim=-1)[0]
+
+# distances along rays where they enter and exit a sphere of radius rad at the origin, where rays
+# which miss it exit before they enter.
+def ray_sphere(r_o, r_d, rad: float):
+  a = (r_d * r_d).sum(dim=-1)
+  b = (r_o * r_d).sum(dim=-1)
+  disc = b * b - a * ((r_o * r_o).sum(dim=-1) - rad * rad)
+  sqrt_disc = disc.clamp(min=0).sqrt()
+  t0 = (-b - sqrt_disc)/a
+  t1 = torch.where(disc < 0, t0 - 1, (-b + sqrt_disc)/a)
+  return t0, t1
+
 def mse2psnr(x): return -10 * torch.log10(x)
 
 def msssim_loss(xs, refs):
@@ -185,7 +232,7 @@ def count_parameters(params): return sum(p.numel() for p in params)
 def load_image(src, resize=None):
   img = Image.open(src)
   if resize is not None: img = img.resize(resize)
-  return torch.from_numpy(np.array(img, dtype=float)/255).float()
+  return torch.from_numpy(np.asarray(img, dtype=np.float32)/255)
 
 # [-1, 1] -> [-pi/2, pi/2]
 #@torch.jit.script